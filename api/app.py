@@ -1,13 +1,64 @@
-import mlflow
-import uvicorn
-import pandas as pd
-from pydantic import BaseModel
-from fastapi import FastAPI
-import joblib
+from startup import startup_timer
+import hmac
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
 import warnings
 
+# Only what scoring needs is imported here: pandas and the MLflow client are
+# imported when a model that requires them is loaded
+with startup_timer.stage('import fastapi'):
+    from pydantic import BaseModel
+    from fastapi import FastAPI, Header, HTTPException
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import PlainTextResponse
+
+with startup_timer.stage('import model serving'):
+    from registry import ModelRegistry, load_model
+    from pool import ProcessPoolModel
+    from batching import BatcherStopped, MicroBatcher
+    from cache import PredictionCache, make_key
+    from vocabulary import CategoryVocabulary, PREPROCESSOR
+    from lookup import PriceTable, PriceTableModel, read_price_table
+    from metrics import MetricsRegistry, RequestMetricsMiddleware, SIZE_BUCKETS, CONTENT_TYPE
+
 warnings.filterwarnings('ignore')
 
+# Compiled model bundled with the API (see `export_model.py`), served by
+# default when present so that startup doesn't go through the MLflow client
+BUNDLED_MODEL = 'data/compiled_model.joblib'
+
+# Model served at startup, either an MLflow model URI or a local joblib file
+# (e.g. `data/RandomForestRegressor.joblib`, or a price table in front of a
+# model, `data/price_table.joblib`)
+MODEL_URI = os.environ.get('MODEL_URI') or (
+    BUNDLED_MODEL if os.path.exists(BUNDLED_MODEL)
+    else 'runs:/65a4c9bc02894e91ae2f325645514393/getaround-optimum-prices')
+
+# Maximum number of cars priced in a single `/predict/batch` call
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE') or 10000)
+
+# Opt-in micro-batching of concurrent `/predict` calls: requests are queued
+# for up to MICRO_BATCH_MAX_DELAY_MS milliseconds or until MICRO_BATCH_MAX_SIZE
+# of them are waiting, then priced with a single call to the model
+MICRO_BATCHING = os.environ.get('MICRO_BATCHING', '').lower() in ('1', 'true', 'yes')
+MICRO_BATCH_MAX_SIZE = int(os.environ.get('MICRO_BATCH_MAX_SIZE') or 32)
+MICRO_BATCH_MAX_DELAY_MS = float(os.environ.get('MICRO_BATCH_MAX_DELAY_MS') or 5)
+
+# Number of processes evaluating the model, 0 to evaluate it in the API
+# process. Requires a compiled model (see `export_model.py`), memory-mapped by
+# every process
+PREDICTION_PROCESSES = int(os.environ.get('PREDICTION_PROCESSES') or 0)
+
+# Cache of recent predictions, keyed on the features and the model version.
+# Set PREDICTION_CACHE_SIZE to 0 to disable it
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE') or 10000)
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL') or 3600)
+
+# Token expected in the `X-Admin-Token` header of admin endpoints, which are
+# disabled when it isn't set: swapping the model loads arbitrary pickles
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') or None
+
 description = """
 Welcome to Getaround's API 😃
 
@@ -16,13 +67,24 @@ Welcome to Getaround's API 😃
 Here are two endpoints you can try:
 * `/`: **GET** request that display a simple default message.
 * `/predict`: **POST** request to get predictions.
+* `/predict/batch`: **POST** request to get predictions for many cars at once.
 
+## Admin Endpoints
+
+* `/admin/model`: **GET** request to see which model is currently served.
+* `/admin/model`: **POST** request to swap the served model without restarting the API.
+* `/admin/cache`: **GET** request to see the statistics of the prediction cache.
+* `/admin/startup`: **GET** request to see how long each step of the API startup took.
+* `/metrics`: **GET** request to scrape the metrics of the API (Prometheus text format).
 
 ## Car Rental Price Prediction
 
 This is an endpoint that uses a State-of-the-art **Machine Learning** model to help you determine the optimum car rental price based on the characteristics of the car.
 
 * `/predict` that accepts `json`
+* `/predict/batch` that accepts a `json` list of cars, or one list per feature (columnar format)
+
+Values of `model_key`, `fuel`, `paint_color` or `car_type` the model was not trained on are ignored by the model, each one is reported in the `warnings` of the response.
 
 
 Check out documentation below 👇 for more information on each endpoint. 
@@ -37,9 +99,178 @@ tags_metadata = [
     {
         "name": "Car Rental Price Prediction",
         "description": "Get a suggestion of car rental price per day based on the characteristics of the car"
+    },
+
+    {
+        "name": "Admin Endpoints",
+        "description": "Manage the model served by the API"
     }
 ]
 
+
+def load_pool_model(source):
+    table = read_price_table(source)
+    if table is not None:
+        # Looked up in the API process, only the other cars go to the pool
+        return PriceTableModel(PriceTable(table), load_pool_model(table['fallback']))
+    return ProcessPoolModel(source, PREDICTION_PROCESSES)
+
+
+def load_default_vocabulary():
+    # Only needed by MLflow models, which import scikit-learn anyway
+    if os.path.exists(PREPROCESSOR):
+        return CategoryVocabulary.from_file(PREPROCESSOR)
+    return None
+
+
+registry = ModelRegistry(
+    loader=load_pool_model if PREDICTION_PROCESSES > 0 else load_model,
+    default_vocabulary=load_default_vocabulary)
+cache = PredictionCache(maxsize=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL)
+batcher = None
+
+# Metrics served at `/metrics`. Recording a value takes a lock and a few
+# arithmetic operations, so they are always on
+metrics = MetricsRegistry()
+http_requests = metrics.counter(
+    'http_requests', "HTTP requests by endpoint and status", ['method', 'endpoint', 'status'])
+http_request_duration = metrics.histogram(
+    'http_request_duration_seconds', "Time spent answering HTTP requests", ['method', 'endpoint'])
+prediction_stage_duration = metrics.histogram(
+    'prediction_stage_duration_seconds',
+    "Time spent in each stage of a call to the model: columns (feature rows to "
+    "columns), encode (categories to codes), lookup (price table), frame "
+    "(DataFrame construction), preprocess, trees, or model when the stages of "
+    "the model can't be timed apart", ['stage'])
+prediction_rows = metrics.histogram(
+    'prediction_rows', "Cars priced per call to the model", buckets=SIZE_BUCKETS)
+unknown_categories = metrics.counter(
+    'unknown_categories', "Values the served model was not trained on, by feature", ['feature'])
+model_loads = metrics.counter(
+    'model_loads', "Model loads by outcome (success or error)", ['status'])
+model_load_duration = metrics.histogram(
+    'model_load_duration_seconds', "Time spent loading models",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120))
+metrics.callback(
+    'model_version', "Version of the model served, increased on every load",
+    lambda: registry.get().version if registry.loaded else None)
+metrics.callback(
+    'prediction_cache_size', "Predictions in the cache", lambda: cache.stats()['size'])
+metrics.callback(
+    'prediction_cache_events', "Prediction cache lookups (hits, misses) and removals (evictions, expirations)",
+    lambda: {(event,): count for event, count in cache.stats().items()
+             if event in ('hits', 'misses', 'evictions', 'expirations')},
+    labels=['event'], type='counter')
+metrics.callback(
+    'price_table_lookups', "Cars found in the price table (hits) or priced by the model (misses)",
+    lambda: price_table_stats(), labels=['result'], type='counter')
+metrics.callback(
+    'startup_stage_duration_seconds', "Time taken by each step of the API startup",
+    lambda: {(stage,): duration for stage, duration in startup_timer.stages.items()},
+    labels=['stage'])
+
+
+def price_table_stats():
+    model = registry.get().model if registry.loaded else None
+    if not isinstance(model, PriceTableModel):
+        return {}
+    return {(result,): count for result, count in model.stats().items()}
+
+
+def stage_timer(stage):
+    return prediction_stage_duration.time(stage=stage)
+
+
+def load_served_model(source):
+    """
+    Loads `source` in the registry, counting the loads and their durations
+    """
+    try:
+        handle = registry.load(source)
+    except Exception:
+        model_loads.inc(status='error')
+        raise
+    model_loads.inc(status='success')
+    model_load_duration.observe(handle.load_time)
+    return handle
+
+
+def predict_rows(rows):
+    """
+    Prices a list of feature rows with a single call to the current model
+    """
+    handle = registry.get()
+    prediction_rows.observe(len(rows))
+    with stage_timer('columns'):
+        columns = rows_to_columns(rows)
+    if handle.vocabulary is not None and getattr(handle.model, 'takes_codes', False):
+        # Categories are looked up once, the model gets their integer codes
+        with stage_timer('encode'):
+            columns.update(handle.vocabulary.encode(columns))
+    prediction = handle.model.predict(columns, timer=stage_timer)
+    return prediction.tolist()
+
+
+def unknown_values(rows, handle):
+    """
+    Warnings for the categorical values of `rows` the model of `handle` was
+    not trained on
+    """
+    if handle.vocabulary is None:
+        return []
+    warnings = handle.vocabulary.unknown_values(rows, FEATURE_COLUMNS)
+    for warning in warnings:
+        unknown_categories.inc(feature=warning['feature'])
+    return warnings
+
+
+def cached_predict_rows(rows):
+    """
+    Same as `predict_rows`, but only the rows missing from the cache go
+    through the model
+    """
+    model_version = registry.get().version
+    keys = [make_key(row, model_version) for row in rows]
+    predictions = [cache.get(key) for key in keys]
+
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    if missing:
+        computed = predict_rows([rows[i] for i in missing])
+        for i, prediction in zip(missing, computed):
+            predictions[i] = prediction
+            cache.set(keys[i], prediction)
+    return predictions
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global batcher
+
+    # Load the model once, it then stays in memory for every request
+    with startup_timer.stage('load model'):
+        load_served_model(MODEL_URI)
+
+    if MICRO_BATCHING:
+        batcher = MicroBatcher(
+            predict_rows,
+            max_batch_size=MICRO_BATCH_MAX_SIZE,
+            max_delay=MICRO_BATCH_MAX_DELAY_MS / 1000,
+            # Keep every process busy
+            concurrency=max(1, PREDICTION_PROCESSES)
+        )
+        await batcher.start()
+
+    startup_timer.finish()
+    yield
+    if batcher is not None:
+        await batcher.stop()
+        batcher = None
+
+    model = registry.get().model
+    if hasattr(model, 'close'):
+        model.close()
+
+
 app = FastAPI(
     title="Getaround API",
     description=description,
@@ -47,7 +278,8 @@ app = FastAPI(
     contact={
         "name": "Getaround"
     },
-    openapi_tags=tags_metadata
+    openapi_tags=tags_metadata,
+    lifespan=lifespan
 )
 
 
@@ -67,6 +299,57 @@ class PredictionFeatures(BaseModel):
     winter_tires: bool = True
 
 
+# Columns expected by the model, in training order
+FEATURE_COLUMNS = list(PredictionFeatures.__fields__)
+
+
+class PredictionFeaturesColumns(BaseModel):
+    model_key: List[str]
+    mileage: List[int]
+    engine_power: List[int]
+    fuel: List[str]
+    paint_color: List[str]
+    car_type: List[str]
+    private_parking_available: List[bool]
+    has_gps: List[bool]
+    has_air_conditioning: List[bool]
+    automatic_car: List[bool]
+    has_getaround_connect: List[bool]
+    has_speed_regulator: List[bool]
+    winter_tires: List[bool]
+
+
+class ModelSource(BaseModel):
+    source: str = "data/RandomForestRegressor.joblib"
+
+
+def features_to_rows(cars):
+    """
+    Feature values of each `PredictionFeatures`, in training order
+    """
+    return [tuple(getattr(car, column) for column in FEATURE_COLUMNS) for car in cars]
+
+
+def columns_to_rows(columns):
+    """
+    Feature values of each car described by `PredictionFeaturesColumns`
+    """
+    lengths = {len(getattr(columns, column)) for column in FEATURE_COLUMNS}
+    if len(lengths) != 1:
+        raise HTTPException(
+            status_code=422, detail="All feature lists must have the same length")
+    return list(zip(*(getattr(columns, column) for column in FEATURE_COLUMNS)))
+
+
+def rows_to_columns(rows):
+    """
+    Turns feature rows into one list of values per column, which is what the
+    models take as input
+    """
+    return {column: list(values)
+            for column, values in zip(FEATURE_COLUMNS, zip(*rows))}
+
+
 @app.get("/", tags=["Introduction Endpoints"])
 async def index():
     """
@@ -83,40 +366,137 @@ async def predict(prediction_features: PredictionFeatures):
     """
     Prediction of Optimimum Rental Price
     """
-    # Read data
-    car_to_rent = pd.DataFrame(
-        {
-            "model_key": [prediction_features.model_key],
-            "mileage": [prediction_features.mileage],
-            "engine_power": [prediction_features.engine_power],
-            "fuel": [prediction_features.fuel],
-            "paint_color": [prediction_features.paint_color],
-            "car_type": [prediction_features.car_type],
-            "private_parking_available": [prediction_features.private_parking_available],
-            "has_gps": [prediction_features.has_gps],
-            "has_air_conditioning": [prediction_features.has_air_conditioning],
-            "automatic_car": [prediction_features.automatic_car],
-            "has_getaround_connect": [prediction_features.has_getaround_connect],
-            "has_speed_regulator": [prediction_features.has_speed_regulator],
-            "winter_tires": [prediction_features.winter_tires],
-        }
-    )
-
-    # Log model from mlflow
-    logged_model = 'runs:/65a4c9bc02894e91ae2f325645514393/getaround-optimum-prices'
-
-    # Load model as a PyFuncModel.
-    loaded_model = mlflow.pyfunc.load_model(logged_model)
-
-    # If you want to load model persisted locally
-    # loaded_model = joblib.load('data/RandomForestRegressor.joblib')
-
-    prediction = loaded_model.predict(car_to_rent)
+    row = features_to_rows([prediction_features])[0]
+    handle = registry.get()
+
+    # Same car already priced by the current model
+    key = make_key(row, handle.version)
+    prediction = cache.get(key)
+
+    if prediction is None:
+        if batcher is not None:
+            # Priced together with the other requests arriving at the same time
+            try:
+                prediction = await batcher.submit(row)
+            except BatcherStopped:
+                raise HTTPException(status_code=503, detail="The API is shutting down")
+        else:
+            # Model evaluation is CPU-bound, keep it away from the event loop
+            prediction = (await run_in_threadpool(predict_rows, [row]))[0]
+        cache.set(key, prediction)
 
     # Format response
-    response = {"prediction": prediction.tolist()[0]}
+    response = {"prediction": prediction,
+                "warnings": unknown_values([row], handle)}
     return response
 
 
+@app.post("/predict/batch", tags=["Car Rental Price Prediction"])
+async def predict_batch(cars: Union[List[PredictionFeatures], PredictionFeaturesColumns]):
+    """
+    Prediction of Optimimum Rental Price for many cars at once.
+
+    Accepts either a list of cars or one list per feature. Predictions are
+    returned in the same order as the cars, the `index` of each warning is
+    the position of its car.
+    """
+    if isinstance(cars, PredictionFeaturesColumns):
+        rows = columns_to_rows(cars)
+    else:
+        rows = features_to_rows(cars)
+
+    if len(rows) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"Batch size is limited to {MAX_BATCH_SIZE} cars")
+    if len(rows) == 0:
+        return {"prediction": [], "warnings": []}
+
+    warnings = unknown_values(rows, registry.get())
+    # Cars missing from the cache go through the pipeline at once
+    prediction = await run_in_threadpool(cached_predict_rows, rows)
+
+    return {"prediction": prediction, "warnings": warnings}
+
+
+def check_admin_token(token):
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN")
+    if token is None or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def describe_model(handle):
+    return {
+        "source": handle.source,
+        "version": handle.version,
+        "loaded_at": handle.loaded_at,
+        "load_time": handle.load_time
+    }
+
+
+@app.get("/admin/model", tags=["Admin Endpoints"])
+async def get_model(x_admin_token: Optional[str] = Header(None)):
+    """
+    Returns the model currently served
+    """
+    check_admin_token(x_admin_token)
+    return describe_model(registry.get())
+
+
+@app.post("/admin/model", tags=["Admin Endpoints"])
+async def swap_model(model_source: ModelSource, x_admin_token: Optional[str] = Header(None)):
+    """
+    Loads a new model (MLflow model URI or local joblib file) and swaps it in.
+    Requests already running finish with the previous model.
+    """
+    check_admin_token(x_admin_token)
+    try:
+        # Loading is slow, keep it away from the event loop
+        handle = await run_in_threadpool(load_served_model, model_source.source)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400, detail=f"Could not load model: {e}")
+
+    # Predictions of the previous model are keyed on its version and can't
+    # be hit anymore, free the memory right away
+    cache.clear()
+    return describe_model(handle)
+
+
+@app.get("/admin/startup", tags=["Admin Endpoints"])
+async def get_startup_times(x_admin_token: Optional[str] = Header(None)):
+    """
+    Returns how long each step of the API startup took, in seconds
+    """
+    check_admin_token(x_admin_token)
+    return startup_timer.report()
+
+
+@app.get("/admin/cache", tags=["Admin Endpoints"])
+async def get_cache_stats(x_admin_token: Optional[str] = Header(None)):
+    """
+    Returns the statistics of the prediction cache
+    """
+    check_admin_token(x_admin_token)
+    return cache.stats()
+
+
+@app.get("/metrics", tags=["Admin Endpoints"], response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Returns the request counters and latencies, the time spent in each stage
+    of the predictions, the model loads and the cache statistics, in the
+    Prometheus text format
+    """
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
+
+
+# Added once every route is defined, requests to other paths are `unmatched`
+app.add_middleware(RequestMetricsMiddleware, requests=http_requests,
+                   durations=http_request_duration,
+                   paths={route.path for route in app.routes})
+
+
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=4000)
@@ -0,0 +1,130 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BatcherStopped(RuntimeError):
+    """
+    Raised to the callers whose items were still waiting when the batcher
+    was stopped
+    """
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single predictions into one vectorized call.
+
+    Incoming items are queued until `max_batch_size` of them are waiting or
+    `max_delay` seconds have passed since the first one arrived. The whole
+    batch is then handed to `predict_batch` in a worker thread, so the event
+    loop keeps accepting requests, and each caller gets back its own result.
+
+    At most `concurrency` batches run at the same time. While they are
+    running new items keep piling up in the queue, which makes the next batch
+    bigger when the API is under load.
+
+    On `stop()`, running batches complete while the items that didn't make it
+    into a batch fail with `BatcherStopped`.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_delay=0.005, concurrency=1):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        self._queue = None
+        self._worker = None
+        self._executor = None
+        self._slots = None
+        # Running batches, referenced so that they aren't garbage collected
+        self._tasks = set()
+        # Items taken from the queue for the next batch
+        self._collecting = []
+        self._stopped = False
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix='micro-batcher')
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopped = True
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+        # Nothing will pick the waiting items up anymore
+        pending = self._collecting
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(BatcherStopped('The micro-batcher is stopped'))
+
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # The batches are done, their threads are idle
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, item):
+        if self._stopped:
+            raise BatcherStopped('The micro-batcher is stopped')
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        # Kept on the batcher, so that `stop()` finds the items taken so far
+        batch = self._collecting = []
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                batch = await self._collect()
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+            self._collecting = []
+            task = asyncio.create_task(self._process(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            # Callers that went away (client disconnected) don't need a result
+            batch = [(item, future)
+                     for item, future in batch if not future.done()]
+            if not batch:
+                return
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self.predict_batch, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+import numpy as np
+import pandas as pd
+
+# Load test of the pricing API: starts `app.py` with a local model and sends
+# it payloads sampled from the training data, `concurrency` requests at a
+# time, then records throughput and latency percentiles.
+#
+# $ python benchmark.py --model data/compiled_model.joblib --concurrency 32
+# $ python benchmark.py --url http://localhost:4000 --mode batch --batch-size 100
+
+# Pricing data the payloads are sampled from
+DATA = '../mlflow/get_around_pricing_project.csv'
+
+# Every run is appended to this file, one JSON object per line
+RESULTS = 'benchmarks/results.jsonl'
+
+# Latency percentiles reported, in milliseconds
+PERCENTILES = [50, 95, 99]
+
+
+def load_cars(path, seed=0):
+    """
+    Cars of the pricing data as `/predict` payloads, in random order
+    """
+    cars = pd.read_csv(path, index_col=0).drop(
+        columns='rental_price_per_day', errors='ignore')
+    cars = cars.sample(frac=1, random_state=seed)
+    # Plain Python values, NumPy scalars aren't JSON serializable
+    return json.loads(cars.to_json(orient='records'))
+
+
+def make_payloads(cars, mode, n_requests, batch_size, seed=0):
+    """
+    `n_requests` request bodies: one car each in single mode, `batch_size`
+    cars drawn with replacement in batch mode
+    """
+    rng = np.random.default_rng(seed)
+    if mode == 'single':
+        return [cars[i] for i in rng.integers(len(cars), size=n_requests)]
+    return [[cars[i] for i in rng.integers(len(cars), size=batch_size)]
+            for _ in range(n_requests)]
+
+
+async def run_load(url, payloads, concurrency, timeout=30):
+    """
+    Sends every payload with at most `concurrency` requests in flight.
+    Returns the latency of each successful request (seconds), the number of
+    failed ones and the total duration.
+    """
+    latencies = []
+    errors = 0
+    queue = iter(payloads)
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+
+        async def worker():
+            nonlocal errors
+            # Single event loop thread: taking the next payload is atomic
+            for payload in queue:
+                start_time = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - start_time
+
+    return np.array(latencies), errors, duration
+
+
+def summarize(latencies, errors, duration, cars_per_request):
+    result = {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'duration': duration,
+        'rps': len(latencies) / duration,
+        'cars_per_second': len(latencies) * cars_per_request / duration,
+    }
+    for percentile in PERCENTILES:
+        result[f'p{percentile}_ms'] = (
+            float(np.percentile(latencies, percentile)) * 1000
+            if len(latencies) else None)
+    return result
+
+
+def git_commit():
+    """
+    Commit of the working tree (suffixed with `-dirty` when it has local
+    changes), None outside of a git checkout
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + '-dirty' if changes else commit
+
+
+def start_api(model, port, env=None):
+    """
+    Starts the API on `port` serving `model`, returns its process once it
+    answers requests
+    """
+    # An API left running on the port would answer instead, and be measured
+    try:
+        httpx.get(f'http://127.0.0.1:{port}/', timeout=1)
+    except httpx.HTTPError:
+        pass
+    else:
+        raise RuntimeError(f'Port {port} is already in use, pass another --port '
+                           'or benchmark that API with --url')
+
+    env = dict(os.environ, MODEL_URI=model, **(env or {}))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port),
+         '--log-level', 'warning'], env=env)
+
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The API exited with code {process.returncode}')
+        try:
+            httpx.get(f'http://127.0.0.1:{port}/', timeout=1).raise_for_status()
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('The API did not start within 120s')
+
+
+def previous_result(path, settings):
+    """
+    Last recorded run with the same settings, None when there is none
+    """
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['settings'] == settings:
+                previous = record
+    return previous
+
+
+def report(settings, result, previous):
+    print(f"{settings['mode']} ({settings['cars_per_request']} car(s) per request, "
+          f"concurrency {settings['concurrency']}): {result['requests']} requests, "
+          f"{result['errors']} errors")
+    columns = ['rps', 'cars_per_second'] + [f'p{p}_ms' for p in PERCENTILES]
+    for column in columns:
+        value = result[column]
+        line = f"  {column:>16}: " + (f"{value:10.2f}" if value is not None else f"{'-':>10}")
+        baseline = previous['result'][column] if previous is not None else None
+        if value is not None and baseline:
+            line += f"  ({value / baseline - 1:+.1%} vs {previous['commit']})"
+        print(line)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Measures the throughput and latency of the pricing API")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--model', default='data/compiled_model.joblib',
+                        help="Local model the API is started with (default: %(default)s)")
+    target.add_argument('--url', help="Benchmark an API that is already running instead")
+    parser.add_argument('--port', type=int, default=4100)
+    parser.add_argument('--mode', choices=['single', 'batch', 'both'], default='both')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="Requests in flight at the same time")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="Requests sent per mode, after the warmup")
+    parser.add_argument('--warmup', type=int, default=100,
+                        help="Requests sent per mode before measuring")
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help="Cars per request in batch mode")
+    parser.add_argument('--data', default=DATA)
+    parser.add_argument('--cache', action='store_true',
+                        help="Keep the prediction cache of the API enabled (sampled "
+                             "cars repeat, so most predictions are then cache hits)")
+    parser.add_argument('--results', default=RESULTS,
+                        help="JSONL file the results are appended to, '' not to record them")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cars = load_cars(args.data, args.seed)
+    process = None
+    if args.url is None:
+        env = {} if args.cache else {'PREDICTION_CACHE_SIZE': '0'}
+        process = start_api(args.model, args.port, env)
+    base_url = (args.url or f'http://127.0.0.1:{args.port}').rstrip('/')
+
+    try:
+        modes = ['single', 'batch'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            url = base_url + ('/predict' if mode == 'single' else '/predict/batch')
+            cars_per_request = 1 if mode == 'single' else args.batch_size
+            asyncio.run(run_load(url, make_payloads(
+                cars, mode, args.warmup, args.batch_size, args.seed + 1), args.concurrency))
+            latencies, errors, duration = asyncio.run(run_load(url, make_payloads(
+                cars, mode, args.requests, args.batch_size, args.seed), args.concurrency))
+            result = summarize(latencies, errors, duration, cars_per_request)
+
+            settings = {
+                'mode': mode,
+                'cars_per_request': cars_per_request,
+                'concurrency': args.concurrency,
+                'model': args.url or args.model,
+                # unknown for an API started elsewhere
+                'cache': None if args.url else args.cache,
+            }
+            previous = previous_result(args.results, settings) if args.results else None
+            report(settings, result, previous)
+
+            if args.results:
+                record = {
+                    'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    'commit': git_commit(),
+                    'settings': settings,
+                    'result': result,
+                }
+                os.makedirs(os.path.dirname(args.results) or '.', exist_ok=True)
+                with open(args.results, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
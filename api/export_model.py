@@ -0,0 +1,57 @@
+import argparse
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from forest import compile_pipeline, CompiledPipeline
+
+# Compiles a trained pricing pipeline into the array-backed format served by
+# `forest.CompiledPipeline`.
+#
+# $ python export_model.py runs:/<run_id>/getaround-optimum-prices
+# $ python export_model.py data/RandomForestRegressor.joblib --check ../data/get_around_pricing_project.csv
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'source', help="MLflow model URI or local joblib file of the fitted Pipeline")
+    parser.add_argument(
+        '--output', default='data/compiled_model.joblib', help="Compiled model file")
+    parser.add_argument(
+        '--check', help="CSV file used to check that predictions are unchanged")
+    args = parser.parse_args()
+
+    if args.source.endswith('.joblib'):
+        pipeline = joblib.load(args.source)
+    else:
+        import mlflow
+        pipeline = mlflow.sklearn.load_model(args.source)
+
+    arrays = compile_pipeline(pipeline)
+    # Not compressed, so that the arrays can be memory-mapped when loading.
+    # Renamed once complete like in `forest.decompress`: a running API maps
+    # the served file, rewriting it in place would truncate it under the API
+    partial = f'{args.output}.{os.getpid()}.partial'
+    joblib.dump(arrays, partial)
+    os.replace(partial, args.output)
+    print(f"Compiled {len(arrays['roots'])} trees "
+          f"({len(arrays['value'])} nodes) into {args.output}")
+
+    if args.check:
+        X = pd.read_csv(args.check, index_col=0)
+        X = X.drop(columns='rental_price_per_day', errors='ignore')
+        compiled = CompiledPipeline(joblib.load(args.output))
+
+        start_time = time.perf_counter()
+        expected = pipeline.predict(X)
+        pipeline_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        predictions = compiled.predict(X)
+        compiled_time = time.perf_counter() - start_time
+
+        print(f"Max prediction difference: {np.abs(predictions - expected).max()}")
+        print(f"Pipeline: {pipeline_time:.3f}s, compiled: {compiled_time:.3f}s "
+              f"for {len(X)} rows")
@@ -0,0 +1,248 @@
+import gzip
+import os
+import shutil
+from contextlib import nullcontext
+
+import numpy as np
+
+# Marker stored in compiled artifacts so that they can be told apart from
+# pickled scikit-learn pipelines when loading a joblib file
+COMPILED_FORMAT = 'getaround-compiled-pipeline'
+
+# Rows are traversed by blocks to bound the size of the (rows x trees) arrays
+BLOCK_SIZE = 4096
+
+
+def compile_pipeline(pipeline):
+    """
+    Flattens the fitted pricing `Pipeline` built in `mlflow/train.py`
+    (ColumnTransformer + RandomForestRegressor) into plain NumPy arrays.
+
+    All the trees are packed in the same node arrays. Child indices are
+    absolute, stored as (left, right) pairs, and leaves point to themselves,
+    which is how the inference engine tells them apart.
+    """
+    preprocessor, regressor = pipeline.steps[0][1], pipeline.steps[-1][1]
+    transformers = {name: (transformer, list(columns))
+                    for name, transformer, columns in preprocessor.transformers_
+                    if name != 'remainder'}
+    if set(transformers) != {'numerical_transformer', 'categorical_transformer'}:
+        raise ValueError(
+            f'Unexpected preprocessing steps: {sorted(transformers)}')
+
+    numerical_transformer, numerical_columns = transformers['numerical_transformer']
+    imputer = numerical_transformer.named_steps['imputer']
+    scaler = numerical_transformer.named_steps['scaler']
+    n_numerical = len(numerical_columns)
+    numerical_mean = scaler.mean_ if scaler.with_mean else np.zeros(n_numerical)
+    numerical_scale = scaler.scale_ if scaler.with_std else np.ones(n_numerical)
+
+    categorical_transformer, categorical_columns = transformers['categorical_transformer']
+    categorical_fill = list(
+        categorical_transformer.named_steps['imputer'].statistics_)
+    encoder = categorical_transformer.named_steps['encoder']
+
+    # Output column of every category, -1 for dropped categories
+    categories, category_positions = [], []
+    position = n_numerical
+    for i, column_categories in enumerate(encoder.categories_):
+        drop = -1 if encoder.drop_idx_ is None or encoder.drop_idx_[i] is None \
+            else int(encoder.drop_idx_[i])
+        positions = np.full(len(column_categories), -1, dtype=np.int32)
+        for code in range(len(column_categories)):
+            if code != drop:
+                positions[code] = position
+                position += 1
+        categories.append(list(column_categories))
+        category_positions.append(positions)
+
+    trees = [estimator.tree_ for estimator in regressor.estimators_]
+    node_counts = np.array([tree.node_count for tree in trees])
+    roots = np.concatenate([[0], np.cumsum(node_counts)[:-1]]).astype(np.int32)
+
+    children, feature, threshold, value = [], [], [], []
+    for root, tree in zip(roots, trees):
+        nodes = np.arange(tree.node_count, dtype=np.int32) + root
+        is_leaf = tree.children_left == -1
+        children.append(np.stack([
+            np.where(is_leaf, nodes, tree.children_left + root),
+            np.where(is_leaf, nodes, tree.children_right + root)
+        ], axis=1))
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+        value.append(tree.value[:, 0, 0])
+
+    return {
+        'format': COMPILED_FORMAT,
+        'numerical_columns': numerical_columns,
+        'numerical_fill': np.asarray(imputer.statistics_, dtype=np.float64),
+        'numerical_mean': np.asarray(numerical_mean, dtype=np.float64),
+        'numerical_scale': np.asarray(numerical_scale, dtype=np.float64),
+        'categorical_columns': categorical_columns,
+        'categorical_fill': categorical_fill,
+        'categories': categories,
+        'category_positions': category_positions,
+        'n_features': position,
+        'roots': roots,
+        'max_depth': max(tree.max_depth for tree in trees),
+        'children': np.concatenate(children).astype(np.int32),
+        'feature': np.concatenate(feature).astype(np.int32),
+        'threshold': np.concatenate(threshold).astype(np.float64),
+        'value': np.concatenate(value).astype(np.float64),
+    }
+
+
+def no_timer(stage):
+    """
+    Default `timer` of the models' `predict`: `timer(stage)` is a context
+    manager timing one stage of the prediction ('frame', 'preprocess',
+    'trees', or 'model' when the stages can't be told apart)
+    """
+    return nullcontext()
+
+
+def decompress(source):
+    """
+    Local joblib file of `source`. Compact models (`.joblib.gz`, see
+    `mlflow/compact.py`) are compressed, they are decompressed once next to
+    the compressed file so that they can be memory-mapped.
+    """
+    if not source.endswith('.joblib.gz'):
+        return source
+    path = source[:-len('.gz')]
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+        # Renamed once complete, other processes never map a partial file
+        partial = f'{path}.{os.getpid()}.partial'
+        with gzip.open(source, 'rb') as src, open(partial, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(partial, path)
+    return path
+
+
+def is_compiled_pipeline(obj):
+    return isinstance(obj, dict) and obj.get('format') == COMPILED_FORMAT
+
+
+class CompiledPipeline:
+    """
+    Vectorized NumPy inference engine for compiled pricing pipelines.
+
+    Gives the same predictions as the original scikit-learn `Pipeline`:
+    features are cast to float32 like scikit-learn does before walking the
+    trees, and tree outputs are summed in the same order.
+
+    Categorical columns are either the raw values or, as NumPy integer
+    arrays, their codes in `arrays['categories']` (see `CategoryVocabulary`).
+    """
+
+    # The API can send it categorical columns already encoded
+    takes_codes = True
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.numerical_columns = arrays['numerical_columns']
+        self.categorical_columns = arrays['categorical_columns']
+        self.n_features = arrays['n_features']
+        self.roots = arrays['roots']
+        self.children = arrays['children'].reshape(-1)
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.value = arrays['value']
+        self.is_leaf = arrays['children'][:, 0] == np.arange(
+            len(arrays['children']))
+
+        # Category -> output column lookups, missing values use the imputed one
+        self.lookups = []
+        for column_categories, positions, fill in zip(
+                arrays['categories'], arrays['category_positions'], arrays['categorical_fill']):
+            lookup = dict(zip(column_categories, positions.tolist()))
+            self.lookups.append((lookup, lookup.get(fill, -1)))
+
+        # Output column of every code, the codes of each column starting at
+        # its offset. The extra last entry (-1) is where unknown codes go
+        positions = [np.asarray(column_positions, dtype=np.intp)
+                     for column_positions in arrays['category_positions']]
+        self.code_offsets = np.cumsum(
+            [0] + [len(column_positions) for column_positions in positions[:-1]])[:, None]
+        self.code_positions = np.concatenate(positions + [np.array([-1])])
+
+    def transform(self, X):
+        """
+        Preprocessing step: `X` is a DataFrame or any mapping of column name to
+        values. Returns the float32 design matrix seen by the trees.
+        """
+        n_rows = len(X[self.numerical_columns[0]])
+        design = np.zeros((n_rows, self.n_features), dtype=np.float64)
+
+        for i, column in enumerate(self.numerical_columns):
+            values = np.asarray(X[column], dtype=np.float64)
+            values = np.where(
+                np.isnan(values), self.arrays['numerical_fill'][i], values)
+            design[:, i] = (values - self.arrays['numerical_mean'][i]) / \
+                self.arrays['numerical_scale'][i]
+
+        if self._encoded(X):
+            # (categorical column, row) codes, -1 for unknown values: every
+            # output column is found with a single lookup
+            codes = np.stack([X[column] for column in self.categorical_columns])
+            positions = self.code_positions[np.where(
+                codes >= 0, codes + self.code_offsets, -1)]
+        else:
+            positions = np.array([
+                [lookup.get(value, fill_position if value is None or value != value else -1)
+                 for value in X[column]]
+                for column, (lookup, fill_position) in zip(self.categorical_columns, self.lookups)],
+                dtype=np.intp).reshape(len(self.categorical_columns), n_rows)
+
+        # Unknown and dropped categories are encoded as all zeros
+        known = positions >= 0
+        rows = np.broadcast_to(np.arange(n_rows), positions.shape)
+        design[rows[known], positions[known]] = 1.0
+
+        return design.astype(np.float32)
+
+    def _encoded(self, X):
+        # Codes come as NumPy integer arrays, raw values never do
+        return all(isinstance(X[column], np.ndarray) and X[column].dtype.kind in 'iu'
+                   for column in self.categorical_columns)
+
+    def predict_transformed(self, design):
+        """
+        Walks every row down every tree and averages the leaf values
+        """
+        n_trees = len(self.roots)
+        prediction = np.empty(len(design), dtype=np.float64)
+        for start in range(0, len(design), BLOCK_SIZE):
+            block = design[start:start + BLOCK_SIZE]
+            n_rows = len(block)
+            flat_block = block.ravel()
+
+            # One (row, tree) pair per entry, ordered tree by tree so that the
+            # final sum adds trees one after the other like scikit-learn does
+            nodes = np.repeat(self.roots.astype(np.intp), n_rows)
+            offsets = np.tile(np.arange(n_rows) * self.n_features, n_trees)
+
+            # Only the pairs that haven't reached a leaf yet are moved down
+            active = np.arange(len(nodes))
+            current = nodes
+            while len(active):
+                go_right = flat_block[offsets + self.feature[current]] \
+                    > self.threshold[current]
+                current = self.children[2 * current + go_right]
+                nodes[active] = current
+                moving = ~self.is_leaf[current]
+                active, current, offsets = \
+                    active[moving], current[moving], offsets[moving]
+
+            # Summed in float64 even when the leaf values are float32
+            # (compact models, see `mlflow/compact.py`)
+            leaf_values = self.value[nodes].reshape(n_trees, n_rows)
+            prediction[start:start + n_rows] = \
+                leaf_values.sum(axis=0, dtype=np.float64) / n_trees
+        return prediction
+
+    def predict(self, X, timer=no_timer):
+        with timer('preprocess'):
+            design = self.transform(X)
+        with timer('trees'):
+            return self.predict_transformed(design)
@@ -0,0 +1,148 @@
+import threading
+
+import joblib
+import numpy as np
+from forest import no_timer
+
+# Marker stored in price tables (see `mlflow/price_table.py`) so that they can
+# be told apart from the other models when loading a joblib file
+PRICE_TABLE_FORMAT = 'getaround-price-table'
+
+
+def is_price_table(obj):
+    return isinstance(obj, dict) and obj.get('format') == PRICE_TABLE_FORMAT
+
+
+def read_price_table(source):
+    """
+    Arrays of the price table at `source` (memory-mapped), None when `source`
+    is another kind of model
+    """
+    if not source.endswith('.joblib'):
+        return None
+    arrays = joblib.load(source, mmap_mode='r')
+    return arrays if is_price_table(arrays) else None
+
+
+def category_codes(categories):
+    """
+    Code of every value of each categorical column (its position in the
+    sorted values of the column), with the number of values of the column
+    """
+    return list(zip(
+        [{value: code for code, value in enumerate(values)} for values in categories],
+        [len(values) for values in categories]))
+
+
+def configuration_keys(X, columns, codes):
+    """
+    Key of the configuration of every car of `X` (the codes of its values in
+    `columns` read as the digits of a mixed-radix number), -1 when one of its
+    values is unknown
+    """
+    keys = []
+    for values in zip(*(X[column] for column in columns)):
+        key = 0
+        for value, (column_codes, radix) in zip(values, codes):
+            code = column_codes.get(value, -1)
+            if code < 0:
+                key = -1
+                break
+            key = key * radix + code
+        keys.append(key)
+    return np.array(keys, dtype=np.int64)
+
+
+class PriceTable:
+    """
+    Prices precomputed by `mlflow/price_table.py` for the car configurations
+    (categorical values) of the training data, at a grid of mileages and
+    engine powers.
+
+    A configuration is found by a binary search on its key, the codes of its
+    values read as a mixed-radix number. The price is then interpolated
+    between the 4 grid points around the mileage and the engine power of the
+    car.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.categorical_columns = arrays['categorical_columns']
+        self.numerical_columns = arrays['numerical_columns']
+        # Plain views of the memory-mapped arrays, indexing np.memmap objects
+        # costs more than the lookup itself for a single car
+        self.keys = np.asarray(arrays['keys'])
+        self.knots = [np.asarray(knots) for knots in arrays['knots']]
+        self.values = np.asarray(arrays['values'])
+        self.codes = category_codes(arrays['categories'])
+
+    def configuration_keys(self, X):
+        return configuration_keys(X, self.categorical_columns, self.codes)
+
+    def lookup(self, X):
+        """
+        Prices of the cars of `X` (mapping of column name to values) and
+        whether each car is covered by the table. The prices of the cars that
+        aren't are meaningless.
+        """
+        keys = self.configuration_keys(X)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        covered = self.keys[positions] == keys
+
+        # Grid cell of every car and where it lies within the cell, along
+        # the mileage and the engine power
+        indices, fractions = [], []
+        for column, knots in zip(self.numerical_columns, self.knots):
+            x = np.asarray(X[column], dtype=np.float64)
+            covered &= (x >= knots[0]) & (x <= knots[-1])
+            i = np.clip(np.searchsorted(knots, x, side='right') - 1, 0, len(knots) - 2)
+            indices.append(i)
+            fractions.append((x - knots[i]) / (knots[i + 1] - knots[i]))
+
+        # Bilinear interpolation between the prices at the corners of the cell
+        (i, j), (fi, fj) = indices, fractions
+        values = self.values
+        prices = (values[positions, i, j] * (1 - fi) * (1 - fj)
+                  + values[positions, i + 1, j] * fi * (1 - fj)
+                  + values[positions, i, j + 1] * (1 - fi) * fj
+                  + values[positions, i + 1, j + 1] * fi * fj)
+        return prices, covered
+
+
+class PriceTableModel:
+    """
+    Prices the cars covered by a `PriceTable` from it and the others with
+    `fallback`, the model the table was built from. Counts how many cars are
+    found in the table (`stats`).
+    """
+
+    def __init__(self, table, fallback):
+        self.table = table
+        self.fallback = fallback
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def predict(self, X, timer=no_timer):
+        with timer('lookup'):
+            prices, covered = self.table.lookup(X)
+        missing = np.flatnonzero(~covered)
+        with self._lock:
+            self._hits += len(prices) - len(missing)
+            self._misses += len(missing)
+
+        if len(missing) == len(prices):
+            return self.fallback.predict(X, timer)
+        if len(missing):
+            columns = {column: np.asarray(values, dtype=object)[missing].tolist()
+                       for column, values in X.items()}
+            prices[missing] = self.fallback.predict(columns, timer)
+        return prices
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses}
+
+    def close(self):
+        if hasattr(self.fallback, 'close'):
+            self.fallback.close()
@@ -0,0 +1,209 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the histograms of the number of cars priced at once
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                      .replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics: a name, a help text and one value per
+    combination of label values, updated under a lock.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """
+        (suffix, label names, label values, value) of every sample
+        """
+        raise NotImplementedError
+
+    def render(self):
+        # Counter families are named after their `_total` sample
+        family = self.name + '_total' if self.type == 'counter' else self.name
+        lines = [f'# HELP {family} {self.documentation}',
+                 f'# TYPE {family} {self.type}']
+        for suffix, names, values, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(names, values)} '
+                         f'{format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [('_total', self.labels, key, value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """
+    Counts the observations falling in each bucket (upper bounds `buckets`)
+    along with their sum. Observing a value is a binary search and an
+    increment, cheap enough for every request.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, then the sum of the observations
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        samples = []
+        for key, counts in sorted(values.items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulated += count
+                samples.append(('_bucket', self.labels + ('le',),
+                                key + (format_value(float(bound)),), cumulated))
+            samples.append(('_count', self.labels, key, cumulated))
+            samples.append(('_sum', self.labels, key, counts[-1]))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """
+    Metric whose values are read when the metrics are scraped: `callback()`
+    returns a value, or a dict of label values (tuples) to values.
+    """
+
+    def __init__(self, name, documentation, callback, labels=(), type='gauge'):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+        self.type = type
+
+    def samples(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        suffix = '_total' if self.type == 'counter' else ''
+        return [(suffix, self.labels, key, value)
+                for key, value in sorted(values.items()) if value is not None]
+
+
+class MetricsRegistry:
+    """
+    Metrics of the API, rendered in the Prometheus text format by `render`
+    """
+
+    def __init__(self, prefix='getaround_'):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(self.prefix + name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self.prefix + name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, callback, labels=(), type='gauge'):
+        return self._register(CallbackMetric(
+            self.prefix + name, documentation, callback, labels, type))
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware counting the HTTP requests and timing them, by endpoint
+    and status. Paths that don't match a route are counted as `unmatched` so
+    that random URLs can't create new series.
+    """
+
+    def __init__(self, app, requests, durations, paths):
+        self.app = app
+        self.requests = requests
+        self.durations = durations
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = scope['path'] if scope['path'] in self.paths else 'unmatched'
+        method = scope['method']
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.durations.observe(time.perf_counter() - start_time,
+                                   method=method, endpoint=endpoint)
+            self.requests.inc(method=method, endpoint=endpoint, status=status)
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+from forest import CompiledPipeline, decompress, is_compiled_pipeline, no_timer
+
+# Batches smaller than this are not worth splitting across processes
+MIN_ROWS_PER_PROCESS = 256
+
+# Model of the current worker process, see `_init_worker`
+_worker_model = None
+
+
+def _init_worker(source):
+    global _worker_model
+    # Memory-mapped, every process reads the same pages of the file
+    _worker_model = CompiledPipeline(joblib.load(source, mmap_mode='r'))
+
+
+def _predict_in_worker(columns):
+    return _worker_model.predict(columns)
+
+
+class ProcessPoolModel:
+    """
+    Serves a compiled model (see `export_model.py`) from a pool of processes.
+
+    Each worker memory-maps the compiled artifact instead of unpickling its
+    own copy, so adding processes doesn't multiply the resident memory by the
+    number of workers. Large batches are split across the workers.
+
+    Once replaced by a swap, the pool is shut down when its last in-flight
+    prediction is done. Requests that read the handle before the swap but
+    predict after the shutdown are served by the API process itself.
+    """
+
+    # Categorical columns can be sent encoded, see `CompiledPipeline`
+    takes_codes = True
+
+    def __init__(self, source, processes=None):
+        source = decompress(source)
+        self.arrays = joblib.load(source, mmap_mode='r')
+        if not is_compiled_pipeline(self.arrays):
+            raise ValueError(
+                f'{source} is not a compiled model, see export_model.py')
+        self.source = source
+        self.processes = processes or os.cpu_count()
+        # Workers are started lazily from threads of the running API, forking
+        # it then could copy locks held by other threads: they are forked
+        # from a clean server process instead
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=_init_worker,
+            initargs=(source,)
+        )
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._closed = False
+        self._local_model = None
+
+    def predict(self, X, timer=no_timer):
+        # The stages run in the workers, only the whole call is timed
+        with timer('model'):
+            return self._predict(X)
+
+    def _predict(self, X):
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._in_flight += 1
+        if closed:
+            if self._local_model is None:
+                self._local_model = CompiledPipeline(self.arrays)
+            return self._local_model.predict(X)
+        try:
+            return self._predict_in_pool(X)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                shutdown = self._closed and not self._in_flight
+            if shutdown:
+                self._executor.shutdown(wait=False)
+
+    def _predict_in_pool(self, X):
+        # Encoded columns stay arrays, cheaper to send to the workers
+        columns = {column: X[column] if isinstance(X[column], np.ndarray) else list(X[column])
+                   for column in X}
+        n_rows = len(next(iter(columns.values())))
+
+        n_chunks = max(1, min(self.processes, n_rows // MIN_ROWS_PER_PROCESS))
+        bounds = np.linspace(0, n_rows, n_chunks + 1).astype(int)
+        futures = [
+            self._executor.submit(
+                _predict_in_worker,
+                {column: values[start:end] for column, values in columns.items()})
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        # Otherwise the last in-flight prediction shuts the pool down
+        with self._lock:
+            self._closed = True
+            shutdown = not self._in_flight
+        if shutdown:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import namedtuple
+
+import joblib
+from forest import CompiledPipeline, decompress, is_compiled_pipeline, no_timer
+from lookup import PriceTable, PriceTableModel, is_price_table
+from vocabulary import model_vocabulary
+
+# Snapshot of the model currently served by the API.
+# `version` is increased on every (re)load so that anything derived from the
+# model (cached predictions, ...) can tell two loads of the same source apart.
+# `vocabulary` holds the categories the model knows (see `CategoryVocabulary`).
+ModelHandle = namedtuple(
+    'ModelHandle', ['model', 'source', 'version', 'loaded_at', 'load_time', 'vocabulary'])
+
+
+class DataFrameModel:
+    """
+    Wraps models that expect a pandas DataFrame (scikit-learn pipelines,
+    MLflow models). Compiled models take the columns as they are, which keeps
+    pandas out of the API when serving them.
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, X, timer=no_timer):
+        import pandas as pd
+        with timer('frame'):
+            X = pd.DataFrame(X)
+
+        steps = getattr(self.model, 'steps', None)
+        if not steps or len(steps) < 2:
+            # MLflow models are a single opaque step
+            with timer('model'):
+                return self.model.predict(X)
+
+        # scikit-learn Pipeline: preprocessing (ColumnTransformer), then the
+        # forest
+        with timer('preprocess'):
+            for _, step in steps[:-1]:
+                X = step.transform(X)
+        with timer('trees'):
+            return steps[-1][1].predict(X)
+
+
+def load_model(source):
+    """
+    Load a model either from a local joblib file (pickled Pipeline, compiled
+    model, see `export_model.py`, compact model, see `mlflow/compact.py`, or
+    price table, see `lookup.py`) or from an MLflow model URI (`runs:/...`,
+    `models:/...`, `s3://...`)
+
+
+    Returns a model whose `predict` takes a mapping of column name to values.
+    """
+    source = decompress(source)
+    if source.endswith('.joblib'):
+        # Arrays of compiled models are memory-mapped rather than copied
+        model = joblib.load(source, mmap_mode='r')
+        if is_compiled_pipeline(model):
+            return CompiledPipeline(model)
+        if is_price_table(model):
+            # Cars outside of the table are priced by the model it was built from
+            return PriceTableModel(PriceTable(model), load_model(model['fallback']))
+        return DataFrameModel(model)
+
+    # The MLflow client is slow to import, only pay for it when needed
+    import mlflow
+    return DataFrameModel(mlflow.pyfunc.load_model(source))
+
+
+class ModelRegistry:
+    """
+    Keeps the pricing model resident in the API process.
+
+    Requests read the current `ModelHandle` with `get()`. A swap loads the new
+    model first and only then replaces the handle, so in-flight requests keep
+    using the model they started with until they are done.
+
+    `loader` turns a source into a model, `load_model` by default. Replaced
+    models that have a `close()` method are closed after the swap.
+    `default_vocabulary()` returns the vocabulary of the models whose own one
+    can't be read (see `model_vocabulary`), when given.
+    """
+
+    def __init__(self, loader=load_model, default_vocabulary=None):
+        self.loader = loader
+        self.default_vocabulary = default_vocabulary
+        self._handle = None
+        self._version = 0
+        self._swap_lock = threading.Lock()
+
+    def load(self, source):
+        start_time = time.perf_counter()
+        model = self.loader(source)
+        vocabulary = model_vocabulary(model)
+        if vocabulary is None and self.default_vocabulary is not None:
+            vocabulary = self.default_vocabulary()
+        load_time = time.perf_counter() - start_time
+
+        # Only one swap at a time, the version counter must stay monotonic
+        with self._swap_lock:
+            previous = self._handle
+            self._version += 1
+            self._handle = ModelHandle(
+                model, source, self._version, time.time(), load_time, vocabulary)
+            handle = self._handle
+
+        if previous is not None and hasattr(previous.model, 'close'):
+            previous.model.close()
+        return handle
+
+    def get(self):
+        handle = self._handle
+        if handle is None:
+            raise RuntimeError('No model loaded yet')
+        return handle
+
+    @property
+    def loaded(self):
+        return self._handle is not None
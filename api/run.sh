@@ -7,4 +7,6 @@ docker run -it \
 -e AWS_SECRET_ACCESS_KEY=$AWS_SECRET_ACCESS_KEY \
 -e BACKEND_STORE_URI=$BACKEND_STORE_URI \
 -e ARTIFACT_ROOT=$ARTIFACT_ROOT \
+-e MODEL_URI=$MODEL_URI \
+-e ADMIN_TOKEN=$ADMIN_TOKEN \
 getaround-api gunicorn app:app --bind 0.0.0.0:4000 --worker-class uvicorn.workers.UvicornWorker --reload
\ No newline at end of file
@@ -0,0 +1,39 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StartupTimer:
+    """
+    Measures how long each step of the API startup takes (imports, model
+    loading, ...) so that slow cold starts can be tracked down.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = OrderedDict()
+        self.total = None
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start_time
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started_at
+        breakdown = ', '.join(f'{name}: {duration:.3f}s'
+                              for name, duration in self.stages.items())
+        print(f'Startup took {self.total:.3f}s ({breakdown})')
+
+    def report(self):
+        return {
+            'stages': dict(self.stages),
+            'total': self.total
+        }
+
+
+# Created on first import, i.e. when `app.py` starts importing its modules
+startup_timer = StartupTimer()
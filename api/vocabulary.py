@@ -0,0 +1,107 @@
+from itertools import repeat
+
+import numpy as np
+from forest import is_compiled_pipeline
+
+# Fitted preprocessing shipped with the API, used for the models whose own
+# preprocessing can't be read (MLflow pyfunc models)
+PREPROCESSOR = 'data/preprocessor.joblib'
+
+# Detail of the warnings returned for out-of-vocabulary values
+UNKNOWN_VALUE = ("Unknown value, the model was not trained on it: it is "
+                 "ignored (one-hot encoded as all zeros)")
+
+
+class CategoryVocabulary:
+    """
+    Categories the one-hot encoder of a model was fitted on, one
+    value -> integer code dict per categorical feature.
+
+    `encode` maps the categorical columns of a request straight to integer
+    codes (-1 for unknown values), which the compiled engine turns into the
+    one-hot design matrix with array lookups. `unknown_values` lists the
+    values the model has never seen, which the encoder would otherwise
+    silently ignore.
+    """
+
+    def __init__(self, categories, fill=None):
+        self.categories = categories
+        self.columns = list(categories)
+        self._codes = {}
+        for column, values in categories.items():
+            codes = {value: code for code, value in enumerate(values)}
+            # Missing values are imputed (most frequent value) before encoding
+            codes[None] = codes.get((fill or {}).get(column), -1)
+            self._codes[column] = codes
+
+    @classmethod
+    def from_compiled(cls, arrays):
+        """
+        Vocabulary of a compiled model (see `forest.compile_pipeline`)
+        """
+        return cls(dict(zip(arrays['categorical_columns'], map(list, arrays['categories']))),
+                   dict(zip(arrays['categorical_columns'], arrays['categorical_fill'])))
+
+    @classmethod
+    def from_preprocessor(cls, preprocessor):
+        """
+        Vocabulary of the fitted `ColumnTransformer` built in `mlflow/train.py`
+        """
+        transformers = {name: (transformer, list(columns))
+                        for name, transformer, columns in preprocessor.transformers_}
+        transformer, columns = transformers['categorical_transformer']
+        encoder = transformer.named_steps['encoder']
+        fill = transformer.named_steps['imputer'].statistics_
+        return cls({column: list(values) for column, values in zip(columns, encoder.categories_)},
+                   dict(zip(columns, fill)))
+
+    @classmethod
+    def from_file(cls, path=PREPROCESSOR):
+        import joblib
+        return cls.from_preprocessor(joblib.load(path))
+
+    def encode(self, columns):
+        """
+        Integer codes of the categorical columns of `columns` (column name ->
+        values), -1 for unknown values
+        """
+        # codes.get(value, -1) for every value without a Python-level loop,
+        # converted to an array at once
+        codes = np.array([list(map(column_codes.get, columns[column], repeat(-1)))
+                          for column, column_codes in self._codes.items()], dtype=np.int32)
+        return dict(zip(self.columns, codes))
+
+    def unknown_values(self, rows, feature_columns):
+        """
+        One warning per categorical value of `rows` (tuples of values in
+        `feature_columns` order) missing from the vocabulary
+        """
+        lookups = [(i, column, self._codes[column])
+                   for i, column in enumerate(feature_columns) if column in self._codes]
+        warnings = []
+        for index, row in enumerate(rows):
+            for i, column, codes in lookups:
+                if row[i] not in codes:
+                    warnings.append({'index': index, 'feature': column,
+                                     'value': row[i], 'detail': UNKNOWN_VALUE})
+        return warnings
+
+
+def model_vocabulary(model):
+    """
+    Vocabulary of a model returned by `registry.load_model` (or of a
+    `ProcessPoolModel`), None when its preprocessing can't be read
+    """
+    # Price tables know the vocabulary of the model they were built from
+    fallback = getattr(model, 'fallback', None)
+    if fallback is not None:
+        return model_vocabulary(fallback)
+
+    arrays = getattr(model, 'arrays', None)
+    if is_compiled_pipeline(arrays):
+        return CategoryVocabulary.from_compiled(arrays)
+
+    steps = getattr(getattr(model, 'model', None), 'steps', None)
+    if steps and hasattr(steps[0][1], 'transformers_'):
+        return CategoryVocabulary.from_preprocessor(steps[0][1])
+    return None
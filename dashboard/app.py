@@ -1,11 +1,20 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+import os
 import warnings
-from utils import generate_pdf
+from functools import partial
+from utils import ReportRenderer
+from charts import threshold_curve_figure, cascade_figure, histogram_bins, box_stats, describe, histogram_figure, box_figure
+from report import ReportBuilder, report_metrics
+from data import source_fingerprint
+from ingest import ingest
+from binning import late_groups, delay_sign, group_counts
+from simulation import ThresholdSimulator, SCOPES
+from chains import RentalChainIndex
+from cascade import propagate_delays
 
 warnings.filterwarnings('ignore')
 
@@ -13,32 +22,74 @@ warnings.filterwarnings('ignore')
 # (not just a single column)
 st.set_page_config(layout='wide')
 
+# a CSV or Parquet export of any size can be analysed instead of the sample
+DATA_SOURCE = os.environ.get(
+    'DELAY_DATA_SOURCE', 'get_around_delay_analysis.xlsx')
 
-@st.cache
-def load_data():
-    df = pd.read_excel('get_around_delay_analysis.xlsx')
-    return df
 
+# the fingerprint of the source file is part of the cache key, so that the
+# data is reloaded as soon as the file changes. The export is read in chunks:
+# only their aggregates and the rentals linked to another one are kept
+@st.experimental_singleton
+def load_data(fingerprint):
+    return ingest(DATA_SOURCE)
 
-@st.cache
-def load_pdf_link():
-    link = generate_pdf('report.html')
-    return link
 
+# built once per version of the data: previous/next rentals are then array
+# lookups instead of joins
+@st.experimental_singleton
+def load_chains(fingerprint):
+    _, linked = load_data(fingerprint)
+    return RentalChainIndex(linked)
 
-pdf_link = load_pdf_link()
 
-col1, col2 = st.columns([8, 2])
+# every threshold/scope query is a lookup in its sorted arrays
+@st.experimental_singleton
+def load_simulator(fingerprint):
+    aggregates, linked = load_data(fingerprint)
+    return ThresholdSimulator(linked, load_chains(fingerprint),
+                              aggregates.scope_rentals(), aggregates.n_ended)
 
 
-def export_report():
-    col2.markdown(pdf_link, unsafe_allow_html=True)
-    st.balloons()
+# aggregates behind the distribution charts, computed once per version of the
+# data instead of sending every row to the browser
+@st.experimental_memo
+def load_chart_data(fingerprint):
+    aggregates, _ = load_data(fingerprint)
+    time_deltas, time_delta_counts = aggregates.value_counts('time_delta')
+    delays, delay_counts = aggregates.value_counts('delay')
+    return {
+        'state_counts': aggregates.counts('state').rename_axis('state').reset_index(name='count'),
+        'time_delta_stats': describe(time_deltas, time_delta_counts),
+        'time_delta_bins': histogram_bins(time_deltas, 30, counts=time_delta_counts),
+        'delay_stats': describe(delays, delay_counts),
+        'delay_bins': histogram_bins(delays, 20, -800, 800, counts=delay_counts),
+        'delay_box': box_stats(delays, delay_counts)
+    }
 
 
-with col2:
-    pdf_link = generate_pdf('report.html')
-    st.markdown(pdf_link, unsafe_allow_html=True)
+@st.experimental_memo
+def load_cascade(fingerprint, threshold, scope):
+    _, linked = load_data(fingerprint)
+    return propagate_delays(linked, load_chains(fingerprint), threshold, scope)
+
+
+# shared by all the sessions, so that a report is rendered once
+@st.experimental_singleton
+def load_report_renderer():
+    return ReportRenderer()
+
+
+@st.experimental_singleton
+def load_report_builder():
+    return ReportBuilder()
+
+
+# the report of the simulated scenario is rendered in the background and its
+# download button filled in once the page is complete
+col1, col2 = st.columns([8, 2])
+report_slot = col2.empty()
+report_slot.caption('Preparing the report...')
 
 col1, col2, col3 = st.columns([2, 6, 2])
 
@@ -52,7 +103,11 @@ st.markdown("""
 """)
 
 data_load_state = st.text('Loading data...')
-df = load_data()
+fingerprint = source_fingerprint(DATA_SOURCE)
+aggregates, linked = load_data(fingerprint)
+chains = load_chains(fingerprint)
+chart_data = load_chart_data(fingerprint)
+simulator = load_simulator(fingerprint)
 # change text from "Loading data..." to "" once the the load_data function has run
 data_load_state.text("")
 
@@ -60,11 +115,11 @@ data_load_state.text("")
 # Run the below code if the check is checked ✅
 if st.checkbox('Show raw data'):
     st.subheader('Raw data')
-    st.write(df)
+    st.write(aggregates.sample)
 
     # Basic stats
-    st.markdown("Number of rows : {}".format(df.shape[0]))
-    st.markdown("Number of columns : {}".format(df.shape[1]))
+    st.markdown("Number of rows : {}".format(aggregates.rows))
+    st.markdown("Number of columns : {}".format(len(aggregates.columns)))
 
 st.markdown('# Data Analysis')
 
@@ -90,23 +145,24 @@ st.markdown('# Data Analysis')
 
 st.markdown('## Descriptive analysis')
 
-st.markdown(f"> there are {len(df['car_id'].unique())} unique cars")
+st.markdown(f"> there are {aggregates.n_cars} unique cars")
 
-tmp = df['checkin_type'].value_counts()
+tmp = aggregates.counts('checkin_type')
 fig = px.pie(values=tmp.values, names=tmp.index,
              title='Proportion of Check-In Type Rentals')
 st.plotly_chart(fig, use_container_width=True)
 
-fig = px.histogram(df,
-                   x='state',
-                   color='state',
-                   text_auto='.0f',
-                   color_discrete_map={
-                       'ended': '#91F5AD', 'canceled': '#FFA69E'},
-                   title='Proportion of Rental state')
+fig = px.bar(chart_data['state_counts'],
+             x='state',
+             y='count',
+             color='state',
+             text_auto='.0f',
+             color_discrete_map={
+                 'ended': '#91F5AD', 'canceled': '#FFA69E'},
+             title='Proportion of Rental state')
 st.plotly_chart(fig, use_container_width=True)
 
-tmp = df.groupby(by=["state", "checkin_type"]).size().reset_index(name="count")
+tmp = aggregates.counts('state_checkin_type').sort_index().reset_index(name="count")
 fig = px.bar(tmp, x="state", y='count', color="checkin_type", barmode="group",
              title='Visualization of Rentals by State and Check-in type', text_auto='.0f')
 st.plotly_chart(fig, use_container_width=True)
@@ -129,10 +185,10 @@ st.markdown("""
 ### **What is the typical/center time before the next rental ?**
 """, unsafe_allow_html=True)
 
-min_time_rental = df['time_delta_with_previous_rental_in_minutes'].min()
-max_time_rental = df['time_delta_with_previous_rental_in_minutes'].max()
-mean_time_rental = df['time_delta_with_previous_rental_in_minutes'].mean()
-median_time_rental = df['time_delta_with_previous_rental_in_minutes'].median()
+min_time_rental = chart_data['time_delta_stats']['min']
+max_time_rental = chart_data['time_delta_stats']['max']
+mean_time_rental = chart_data['time_delta_stats']['mean']
+median_time_rental = chart_data['time_delta_stats']['median']
 
 st.markdown(f"""
 Min/Max/Mean/Median time needed for the owner to rent again a car :
@@ -144,10 +200,10 @@ Min/Max/Mean/Median time needed for the owner to rent again a car :
 <br />
 """, unsafe_allow_html=True)
 
-fig = px.histogram(df,
-                   x='time_delta_with_previous_rental_in_minutes',
-                   title='Distribution of time_delta_with_previous_rental_in_minutes'
-                   )
+fig = histogram_figure(chart_data['time_delta_bins'], 30,
+                       x='time_delta_with_previous_rental_in_minutes',
+                       title='Distribution of time_delta_with_previous_rental_in_minutes'
+                       )
 fig.add_vline(x=mean_time_rental, line_width=3, line_dash="dash",
               line_color="black", annotation_text='mean')
 fig.add_vline(x=median_time_rental, line_width=3, line_dash="dash",
@@ -164,30 +220,15 @@ This type of distribution is called a right-skewed or positive-skewed distributi
 ### **Will the vehicle be rented immediately?**
 """, unsafe_allow_html=True)
 
-# Rental Ended
-df_delay_rented = df.dropna(subset='delay_at_checkout_in_minutes').copy()
-
-list_to_add = []
-
-for value in df_delay_rented['time_delta_with_previous_rental_in_minutes']:
-    if value >= 0.0 and value <= 180.0:
-        list_to_add.append('time delta btw 0 and 3 hours')
-    else:
-        list_to_add.append('time delta > 3 hours')
-
-df_delay_rented['time_delta_previous_rental_label'] = list_to_add
-
-df_delay_rented['time_delta_previous_rental_label'].value_counts(
-    normalize=True)
-
 fig = make_subplots(rows=1, cols=2, column_widths=[0.6, 0.4], specs=[
                     [{'type': 'domain'}, {'type': 'xy'}]])
 
 labels = 'rented later than 3 hours', 'rented less than 3 hours'
+# Rental Ended
+tmp = aggregates.counts('time_delta_label')
 fig.add_trace(
     go.Pie(
-        values=df_delay_rented['time_delta_previous_rental_label'].value_counts(
-        ),
+        values=tmp,
         labels=labels,
         title='Proportion of cars rented later than 3 hours'
     ),
@@ -195,7 +236,7 @@ fig.add_trace(
 )
 
 fig.add_trace(
-    go.Histogram(x=df_delay_rented['time_delta_previous_rental_label']),
+    go.Bar(x=tmp.index.astype(str), y=tmp.values),
     row=1, col=2
 )
 
@@ -215,32 +256,32 @@ st.markdown("""
 ### **How far drivers are late at checkout?**
 """, unsafe_allow_html=True)
 
-# Rental Ended
-df_checkout = df.dropna(subset='delay_at_checkout_in_minutes').copy()
-
-df_checkout['checkout_status'] = df_checkout['delay_at_checkout_in_minutes'].apply(
-    lambda x: 'out_of_time' if x >= 0 else 'in_time')
+# Rental Ended: distinct checkout delays and their number of rentals
+delays, delay_counts = aggregates.value_counts('delay')
 
-tmp = df_checkout['checkout_status'].value_counts()
+# a delay of 0 is already out of time
+tmp = group_counts(delay_sign(delays, 'in_time', 'out_of_time', right=False),
+                   delay_counts)
 fig = px.pie(values=tmp.values, names=tmp.index,
              title='Proportion of Checkout Status')
 st.plotly_chart(fig, use_container_width=True)
 
-fig = px.histogram(df_checkout, x='delay_at_checkout_in_minutes', range_x=(-800, 800),
-                   title='Distribution of delay_at_checkout_in_minutes ')
+fig = histogram_figure(chart_data['delay_bins'], 20, x='delay_at_checkout_in_minutes',
+                       xaxis_range=(-800, 800),
+                       title='Distribution of delay_at_checkout_in_minutes ')
 st.plotly_chart(fig, use_container_width=True)
 
 # The majority of the delay within checkout distribution is between **-200** and **200** minutes
 
-fig = px.box(df_checkout, y="delay_at_checkout_in_minutes",
-             range_y=(-15000, 15000))
+fig = box_figure(chart_data['delay_box'], y="delay_at_checkout_in_minutes",
+                 yaxis_range=(-15000, 15000))
 st.plotly_chart(fig, use_container_width=True)
 
 st.markdown(f"""
 Description of ```delay_at_checkout_in_minutes```
 | Min | Max  | Mean  |  Median |
 |---|---|---|---|
-| {df_checkout['delay_at_checkout_in_minutes'].min()}  | {df_checkout['delay_at_checkout_in_minutes'].max()}  | { df_checkout['delay_at_checkout_in_minutes'].mean()}  |  { df_checkout['delay_at_checkout_in_minutes'].median()} |
+| {chart_data['delay_stats']['min']}  | {chart_data['delay_stats']['max']}  | { chart_data['delay_stats']['mean']}  |  { chart_data['delay_stats']['median']} |
 
 <br />
 """, unsafe_allow_html=True)
@@ -253,12 +294,11 @@ st.markdown("""
 ### **How this late impact the next driver**
 """, unsafe_allow_html=True)
 
-all_cancelations = df.loc[(df['state'] == 'canceled')]
-cancelations_affected_by_previous_rental = df.loc[(
-    df['state'] == 'canceled') & (~df['previous_ended_rental_id'].isna())]
+canceled = (linked['state'] == 'canceled').to_numpy()
+affected_by_previous_rental = canceled & (chains.previous >= 0)
 
-cancelation_desc = pd.DataFrame([[all_cancelations.shape[0], 'all_cancelations'], [
-                                cancelations_affected_by_previous_rental.shape[0], 'cancelations_affected_by_previous_rental']], columns=['count', 'state'])
+cancelation_desc = pd.DataFrame([[aggregates.counts('state').get('canceled', 0), 'all_cancelations'], [
+                                affected_by_previous_rental.sum(), 'cancelations_affected_by_previous_rental']], columns=['count', 'state'])
 
 fig = px.bar(cancelation_desc, x='state', y='count', color='state',
              title='Description of Cancelation', text_auto='.0f')
@@ -268,14 +308,13 @@ st.markdown("""
 > #### So 3265 - 229 = 3036 , so we don't know the reasons why <font color="red">3036</font> rentals are canceled.
 """, unsafe_allow_html=True)
 
-df_canceled = df.loc[(df['state'] == 'canceled') & (
-    ~df['previous_ended_rental_id'].isna())]
+df_canceled = linked.loc[affected_by_previous_rental].copy()
 
-df_canceled = df_canceled.merge(right=df, how='left', left_on='previous_ended_rental_id',
-                                right_on='rental_id', suffixes=(None, '_previous'))
+df_canceled['delay_at_checkout_in_minutes_previous'] = chains.previous_values(
+    linked['delay_at_checkout_in_minutes'])[affected_by_previous_rental]
 
-df_canceled['checkout_status_previous'] = df_canceled['delay_at_checkout_in_minutes_previous'].apply(
-    lambda x: 'out_of_time' if x > 0 else 'in_time')
+df_canceled['checkout_status_previous'] = delay_sign(
+    df_canceled['delay_at_checkout_in_minutes_previous'], 'in_time', 'out_of_time')
 
 tmp = df_canceled['checkout_status_previous'].value_counts()
 fig = px.pie(values=tmp.values, names=tmp.index,
@@ -289,16 +328,16 @@ st.markdown("""
 
 # keeps only the delays and sets the other values to 0,
 # otherwise we set previous early checkouts to 0 and keeps late checkouts.
-df_canceled['delay_at_checkout_with_previous_rental'] = df_canceled['delay_at_checkout_in_minutes_previous'].apply(
-    lambda x: x if x > 0 else 0)
+df_canceled['delay_at_checkout_with_previous_rental'] = df_canceled['delay_at_checkout_in_minutes_previous'].where(
+    df_canceled['delay_at_checkout_in_minutes_previous'] > 0, 0)
 
 # calculate the delay at checkin
 df_canceled['delay_at_checkin_in_minutes'] = df_canceled['delay_at_checkout_with_previous_rental'] - \
     df_canceled['time_delta_with_previous_rental_in_minutes']
 
 # create a new feature : delay_checkin yes or no
-df_canceled['delay_checkin'] = df_canceled['delay_at_checkin_in_minutes'].apply(
-    lambda x: "yes" if x > 0 else "no")
+df_canceled['delay_checkin'] = delay_sign(
+    df_canceled['delay_at_checkin_in_minutes'], 'no', 'yes')
 
 tmp = df_canceled['delay_checkin'].value_counts()
 fig = px.pie(values=tmp.values, names=['other_reasons', 'previous_driver_late'], title='Proportion of Delay Checkin', color_discrete_map={
@@ -314,58 +353,22 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
-st.markdown(""" 
-> ##### There are <font color='green'>31 cancelations so 83% of cancelations from late checkouts</font> could be prevent if we put a threshold of 3 hours.
+simulation = simulator.simulate(180)
+st.markdown(f""" 
+> ##### There are <font color='green'>{simulation.canceled_solved} cancelations so {simulation.canceled_solved / max(simulation.canceled_conflicts, 1):.0%} of cancelations from late checkouts</font> could be prevent if we put a threshold of 3 hours.
 
 <br />
 
 ### Should we enable the feature for all cars?, only Connect cars?
 """, unsafe_allow_html=True)
 
-df_checkout_late = df_checkout[df_checkout['checkout_status'] == 'out_of_time']
-
-list_to_add = []
-
-for value in df_checkout_late['delay_at_checkout_in_minutes']:
-    if value > 0.0 and value <= 60.0:
-        list_to_add.append('late <= 1 hour')
-    elif value > 60.0 and value <= 120.0:
-        list_to_add.append('late btw 1 and 2 hours')
-    elif value > 120.0 and value <= 180.0:
-        list_to_add.append('late btw 2 and 3 hours')
-    elif value > 180.0 and value <= 240.0:
-        list_to_add.append('late btw 3 and 4 hours')
-    elif value > 240.0 and value <= 360:
-        list_to_add.append('late btw 4 and 6 hours')
-    elif value > 360 and value <= 1440.0:                   # 24 * 60.0 = 1440, 1 day
-        list_to_add.append('late btw 6h and 1 day')
-    elif value > 1440.0 and value <= 2880.0:                # 2 days
-        list_to_add.append('late btw 1 and 2 days')
-    elif value > 2880.0 and value <= 4320.0:                # 3 days
-        list_to_add.append('late btw 2 and 3 days')
-    elif value > 4320.0 and value <= 5760.0:                # 4 days
-        list_to_add.append('late btw 3 and 4 days')
-    elif value > 4320.0 and value <= 7200.0:                # 5 days
-        list_to_add.append('late btw 4 and 5 days')
-    elif value > 7200.0 and value <= 8640.0:                # 6 days
-        list_to_add.append('late btw 5 and 6 days')
-    elif value > 8640.0 and value <= 10080.0:               # 7 days
-        list_to_add.append('late btw 6 and 7 days')
-    elif value > 10080.0 and value <= 11520.0:              # 8 days
-        list_to_add.append('late btw 7 and 8 days')
-    elif value > 11520.0 and value <= 12960.0:              # 9 days
-        list_to_add.append('late btw 8 and 9 days')
-    elif value > 12960.0 and value <= 14400.0:              # 10 days
-        list_to_add.append('late btw 9 and 10 days')
-    else:
-        list_to_add.append('late more than 10 days')
-
-df_checkout_late['late_groups'] = list_to_add
+late = delays >= 0
+tmp_all_checkin = group_counts(late_groups(delays[late]), delay_counts[late])
 
-tmp_all_checkin = df_checkout_late['late_groups'].value_counts()
-
-tmp_connect = df_checkout_late.loc[df_checkout_late['checkin_type']
-                                   == 'connect', 'late_groups'].value_counts()
+connect_delays, connect_counts = aggregates.value_counts('delay', 'connect')
+connect_late = connect_delays >= 0
+tmp_connect = group_counts(late_groups(
+    connect_delays[connect_late]), connect_counts[connect_late])
 
 fig = go.Figure()
 
@@ -405,25 +408,85 @@ st.markdown("""
 > The feature realized with a threshold of 3 hours on all cars / checkin types
 """, unsafe_allow_html=True)
 
-list_to_add = []
-
-for value in df_checkout_late['delay_at_checkout_in_minutes']:
-    if value > 0.0 and value <= 180.0:
-        list_to_add.append(True)
-    else:
-        list_to_add.append(False)
-
-df_checkout_late['solved'] = list_to_add
+solved = (delays[late] > 0) & (delays[late] <= 180)
 
-tmp = df_checkout_late['solved'].value_counts()
+tmp = group_counts(solved, delay_counts[late])
 fig = px.pie(values=tmp.values, names=tmp.index,
              title='Proportion of Solved Cases with a threshold of 3 hours on all cars / checkin types')
 st.plotly_chart(fig, use_container_width=True)
 
+st.markdown(f""" 
+> The feature realized with a threshold of 3 hours on all cars / checkin types should solve almost <font color="#5FBA7C">{tmp.get(True, 0)}</font> problematic cases.
+
+<br />
+
+### Simulate a threshold and a scope
+""", unsafe_allow_html=True)
+
+col1, col2 = st.columns([6, 4])
+threshold = col1.slider('Minimum delay between two rentals (minutes)',
+                        0, 720, 180, step=15)
+scope = col2.radio('Scope', SCOPES, horizontal=True)
+
+simulation = simulator.simulate(threshold, scope)
+
+col1, col2, col3, col4 = st.columns(4)
+col1.metric('Blocked rentals', simulation.blocked,
+            help=f'out of {simulation.rentals} rentals in scope')
+col2.metric('Revenue affected', f'{simulation.revenue_share:.1%}',
+            help='share of the ended rentals that would have been blocked')
+col3.metric('Late checkin conflicts solved',
+            f'{simulation.solved} / {simulation.conflicts}')
+col4.metric('Cancelations prevented',
+            f'{simulation.canceled_solved} / {simulation.canceled_conflicts}')
+
+threshold_curve = threshold_curve_figure(simulator, threshold, scope)
+st.plotly_chart(threshold_curve, use_container_width=True)
+
 st.markdown(""" 
-> The feature realized with a threshold of 3 hours on all cars / checkin types should solve almost <font color="#5FBA7C">7679</font> problematic cases.
+#### Delays rippling through several rentals
+
+A driver who gets the car late also gives it back late, which can delay the next driver, and so on along the rentals of the car.
 """, unsafe_allow_html=True)
 
+cascade_before = load_cascade(fingerprint, 0, 'all')
+cascade_after = load_cascade(fingerprint, threshold, scope)
+
+col1, col2, col3 = st.columns(3)
+col1.metric('Checkins delayed by the previous rental only',
+            int((cascade_before['direct_checkin_delay'] > 0).sum()))
+col2.metric('Checkins delayed, cascades included',
+            int((cascade_before['checkin_delay'] > 0).sum()))
+col3.metric('Checkins still delayed with the feature',
+            int((cascade_after['checkin_delay'] > 0).sum()),
+            delta=int((cascade_after['checkin_delay'] > 0).sum() -
+                      (cascade_before['checkin_delay'] > 0).sum()),
+            delta_color='inverse')
+
+cascade = cascade_figure(chains, cascade_before,
+                         cascade_after, threshold, scope)
+st.plotly_chart(cascade, use_container_width=True)
+
+scenario_metrics = report_metrics(
+    aggregates, simulation, cascade_before, cascade_after)
+scenario_figures = {'threshold_curve': threshold_curve, 'cascade': cascade}
+report_key = load_report_renderer().submit(
+    load_report_builder().content(scenario_metrics, scenario_figures),
+    partial(load_report_builder().build, scenario_metrics, scenario_figures))
+
+# Not waited for: the page is done while kaleido and fpdf render the report
+try:
+    report = load_report_renderer().get(report_key, timeout=0)
+except Exception as e:
+    report_slot.error(f'The report could not be generated: {e}')
+else:
+    if report is None:
+        # Clicking reruns the script, which picks the report up once rendered
+        report_slot.button('⏳ Preparing report… (click to refresh)')
+    else:
+        report_slot.download_button('🚀 Export Report', report,
+                                    file_name='report.pdf', mime='application/pdf')
+
 # # Conclusion
 
 # - The feature might be realized with a thresold of 3 hours (on all cars / checkin types)
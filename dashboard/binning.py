@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+INF = float('inf')
+
+# Time between two rentals of the same car, in minutes
+TIME_DELTA_EDGES = [0, 180]
+TIME_DELTA_LABELS = ['time delta btw 0 and 3 hours']
+TIME_DELTA_DEFAULT = 'time delta > 3 hours'
+
+# Delay at checkout of the late rentals, in minutes: each group goes from its
+# lower edge (excluded) to its upper edge (included)
+LATE_EDGES = [
+    0, 60, 120, 180, 240, 360,
+    1440,   # 24 * 60.0 = 1440, 1 day
+    2880,   # 2 days
+    4320,   # 3 days
+    5760,   # 4 days
+    7200,   # 5 days
+    8640,   # 6 days
+    10080,  # 7 days
+    11520,  # 8 days
+    12960,  # 9 days
+    14400,  # 10 days
+    INF
+]
+LATE_LABELS = [
+    'late <= 1 hour',
+    'late btw 1 and 2 hours',
+    'late btw 2 and 3 hours',
+    'late btw 3 and 4 hours',
+    'late btw 4 and 6 hours',
+    'late btw 6h and 1 day',
+    'late btw 1 and 2 days',
+    'late btw 2 and 3 days',
+    'late btw 3 and 4 days',
+    'late btw 4 and 5 days',
+    'late btw 5 and 6 days',
+    'late btw 6 and 7 days',
+    'late btw 7 and 8 days',
+    'late btw 8 and 9 days',
+    'late btw 9 and 10 days',
+    'late more than 10 days'
+]
+
+# Sign of a delay: early (or missing) vs late
+SIGN_EDGES = [-INF, 0, INF]
+
+
+def bin_values(values, edges, labels, right=True, include_lowest=False, default=None):
+    """
+    Labels each value with the bin of `edges` it falls in.
+
+    Bin i goes from edges[i] to edges[i + 1] and is labeled labels[i]; with
+    `right` its upper edge is included, otherwise its lower one is. Missing
+    values and values outside of the edges get `default` (or stay missing
+    when there is none).
+
+    The bins are found with one binary search over the whole array and the
+    result is a Categorical (one small integer code per value), so labeling a
+    million rows takes a few milliseconds.
+    """
+    values = np.asarray(values, dtype='float64')
+    edges = np.asarray(edges, dtype='float64')
+    if len(labels) != len(edges) - 1:
+        raise ValueError(
+            f'{len(edges)} edges make {len(edges) - 1} bins, got {len(labels)} labels')
+
+    codes = np.digitize(values, edges, right=right) - 1
+    if include_lowest:
+        # The outer edge of the first (resp. last) bin is included as well
+        codes[values == edges[0 if right else -1]] = 0 if right else len(labels) - 1
+    outside = (codes < 0) | (codes >= len(labels)) | np.isnan(values)
+
+    categories = list(labels)
+    if default is None:
+        codes[outside] = -1
+    else:
+        if default not in categories:
+            categories.append(default)
+        codes[outside] = categories.index(default)
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+
+def time_delta_groups(time_deltas):
+    """
+    Whether the car was rented again within 3 hours
+    """
+    return bin_values(time_deltas, TIME_DELTA_EDGES, TIME_DELTA_LABELS,
+                      include_lowest=True, default=TIME_DELTA_DEFAULT)
+
+
+def late_groups(delays):
+    """
+    Groups late checkouts (delays >= 0) by how long the driver was late
+    """
+    return bin_values(delays, LATE_EDGES, LATE_LABELS, include_lowest=True)
+
+
+def delay_sign(delays, early, late, right=True):
+    """
+    Labels delays `late` when they are positive, `early` otherwise (missing
+    delays included). With `right=False`, a delay of 0 is already late.
+    """
+    return bin_values(delays, SIGN_EDGES, [early, late], right=right, default=early)
+
+
+def group_counts(groups, counts):
+    """
+    Number of rentals in each group, from the groups of distinct values and
+    the number of rentals of each value, most frequent first like
+    `value_counts`
+    """
+    return pd.Series(counts).groupby(groups).sum().sort_values(ascending=False, kind='stable')
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+
+# Rentals walked at once: chains are never split, so a block can be a little
+# bigger
+BLOCK_SIZE = 1_000_000
+
+
+def chain_blocks(roots, block_size=BLOCK_SIZE):
+    """
+    (start, end) slices of `roots` (chain of each rental, chains contiguous)
+    of about `block_size` rentals, cut between two chains
+    """
+    chain_starts = np.flatnonzero(np.r_[True, roots[1:] != roots[:-1]])
+    cuts = chain_starts[np.searchsorted(
+        chain_starts, np.arange(block_size, len(roots), block_size))]
+    bounds = np.unique(np.r_[0, cuts, len(roots)])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def propagate_delays(df, chains, threshold=0, scope='all', block_size=BLOCK_SIZE):
+    """
+    Delays at checkin once late checkouts ripple through the chains of
+    consecutive rentals of a car (see `RentalChainIndex`).
+
+    A driver who gets the car `c` minutes late and is `d` minutes late at
+    checkout (their own delay, as recorded) gives it back `c + d` minutes
+    after the planned end. The next driver, booked `gap` minutes after it,
+    then gets it c' = max(0, c + d - gap) minutes late. With a minimum delta
+    `threshold` enabled on `scope` ('all', 'connect' or 'mobile'), rentals
+    of the scope are booked at least `threshold` minutes after the previous
+    one.
+
+    Along a chain this is the Lindley recursion, whose solution is the
+    cumulated `d - gap` minus its running minimum: it is computed for every
+    chain at once with grouped cumulative sums and minimums, `block_size`
+    rentals at a time to bound the memory used.
+
+    Returns, aligned with `df`:
+    - direct_checkin_delay: delay caused by the previous rental alone
+    - checkin_delay: delay once propagated along the chain
+    - checkout_lateness: when ended rentals were given back, relative to their
+      planned end
+    """
+    own_delay = df['delay_at_checkout_in_minutes'].fillna(
+        0).to_numpy(dtype='float64')
+    gap = df['time_delta_with_previous_rental_in_minutes'].to_numpy(
+        dtype='float64', na_value=np.inf)
+    if scope == 'all':
+        in_scope = np.ones(len(df), dtype=bool)
+    else:
+        in_scope = (df['checkin_type'] == scope).to_numpy()
+    gap = np.where(in_scope, np.maximum(gap, threshold), gap)
+
+    has_previous = chains.previous >= 0
+    step = np.where(has_previous, chains.previous_values(own_delay) - gap, 0)
+    checkin_delay = np.zeros(len(df))
+
+    # Ended rentals, chain after chain, each one in order: the first rental
+    # of a chain has no previous one, so every cumulated sum starts at 0
+    ended = (df['state'] == 'ended').to_numpy()
+    order = chains.chain_order[ended[chains.chain_order]]
+    roots = chains.root[order]
+    for start, end in chain_blocks(roots, block_size):
+        positions = order[start:end]
+        chain = pd.Series(roots[start:end])
+        cumulated = pd.Series(step[positions]).groupby(
+            chain, sort=False).cumsum()
+        running_min = cumulated.groupby(chain, sort=False).cummin()
+        checkin_delay[positions] = (cumulated - running_min).to_numpy()
+
+    # Canceled rentals are leaves: delayed by their previous rental, they
+    # don't delay anybody
+    leaves = np.flatnonzero(~ended & has_previous)
+    checkin_delay[leaves] = np.maximum(
+        checkin_delay[chains.previous[leaves]] + step[leaves], 0)
+
+    return pd.DataFrame({
+        'direct_checkin_delay': np.where(has_previous, np.maximum(step, 0), np.nan),
+        'checkin_delay': np.where(has_previous, checkin_delay, np.nan),
+        'checkout_lateness': np.where(ended, checkin_delay + own_delay, np.nan)
+    }, index=df.index)
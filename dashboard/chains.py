@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# Rental ids are looked up in a table indexed by id as long as it is at most
+# this many times bigger than the number of rentals, by binary search otherwise
+MAX_TABLE_RATIO = 8
+
+
+class RentalChainIndex:
+    """
+    Positional index of the rentals and of the chains they form.
+
+    A rental points to the ended rental that came just before it on the same
+    car (`previous_ended_rental_id`). An ended rental is followed by at most
+    one ended rental, so the ended rentals of a car form chains, canceled
+    rentals hanging off them as leaves.
+
+    Everything is kept as arrays of positions in the DataFrame (-1 when there
+    is no such rental), so that looking up the previous or next rental of any
+    set of rentals is a gather instead of a join:
+
+    - previous / next: position of the previous rental / of the next ended one
+    - root: position of the first rental of the chain
+    - rank: number of rentals before it in the chain
+    - chain_length: number of ended rentals of the chain
+    - chain_order: positions sorted by car, chain and rank
+    """
+
+    def __init__(self, df):
+        self.size = len(df)
+        rental_ids = df['rental_id'].to_numpy(dtype=np.int64)
+        self._min_id = rental_ids.min() if self.size else 0
+        span = rental_ids.max() - self._min_id + 1 if self.size else 0
+        if span <= MAX_TABLE_RATIO * max(self.size, 1):
+            # Ids are dense enough to be looked up in a table of positions
+            self._table = np.full(span, -1, dtype=np.int64)
+            self._table[rental_ids - self._min_id] = np.arange(self.size)
+        else:
+            self._table = None
+            self._order = np.argsort(rental_ids, kind='stable')
+            self._sorted_ids = rental_ids[self._order]
+
+        self.previous = self.positions(df['previous_ended_rental_id'])
+
+        ended = (df['state'] == 'ended').to_numpy()
+        followed = np.flatnonzero((self.previous >= 0) & ended)
+        self.next = np.full(self.size, -1, dtype=np.int64)
+        self.next[self.previous[followed]] = followed
+
+        self.root, self.rank = self._walk_chains()
+        self.chain_length = np.bincount(
+            self.root, weights=ended, minlength=self.size).astype(np.int64)[self.root]
+        self.chain_order = np.lexsort(
+            (self.rank, self.root, df['car_id'].to_numpy()))
+
+    def _walk_chains(self):
+        # Pointer jumping: every pass doubles how far back each rental looks,
+        # so a chain of n rentals is walked in log2(n) vectorized passes
+        positions = np.arange(self.size)
+        parent = np.where(self.previous >= 0, self.previous, positions)
+        rank = (self.previous >= 0).astype(np.int64)
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                return parent, rank
+            rank = rank + rank[parent]
+            parent = grand_parent
+
+    def positions(self, rental_ids):
+        """
+        Positions of the given rental ids in the DataFrame, -1 when unknown
+        """
+        rental_ids = pd.Series(rental_ids)
+        missing = rental_ids.isna().to_numpy()
+        rental_ids = rental_ids.to_numpy(dtype=np.int64, na_value=-1)
+
+        if self._table is not None:
+            offsets = rental_ids - self._min_id
+            known = ~missing & (offsets >= 0) & (offsets < len(self._table))
+            return np.where(known, self._table[np.where(known, offsets, 0)], -1)
+
+        found = np.searchsorted(self._sorted_ids, rental_ids)
+        found = np.minimum(found, len(self._sorted_ids) - 1)
+        known = ~missing & (self._sorted_ids[found] == rental_ids)
+        return np.where(known, self._order[found], -1)
+
+    @staticmethod
+    def gather(values, positions):
+        """
+        `values` at `positions`, NaN where the position is -1
+        """
+        values = np.asarray(values, dtype='float64')
+        return np.where(positions >= 0, values[positions], np.nan)
+
+    def previous_values(self, values):
+        return self.gather(values, self.previous)
+
+    def next_values(self, values):
+        return self.gather(values, self.next)
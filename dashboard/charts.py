@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+# Thresholds of the simulation curves, in minutes
+CURVE_THRESHOLDS = np.arange(0, 721, 15)
+
+# Outliers of a box plot are summarized by this many of their quantiles
+MAX_OUTLIER_POINTS = 100
+
+
+# The functions below aggregate the data before it is plotted, so that a
+# chart sends a few dozen numbers to the browser whatever the number of rows.
+# They take either the values themselves or distinct values and how many
+# times each one occurs (`counts`, see `DelayAggregates`)
+
+def distinct_values(values, counts=None):
+    """
+    Sorted distinct values (NaN dropped) and how many times each one occurs
+    """
+    values = np.asarray(values, dtype='float64')
+    if counts is None:
+        values = values[~np.isnan(values)]
+        return np.unique(values, return_counts=True)
+
+    counts = np.asarray(counts)
+    known = ~np.isnan(values) & (counts > 0)
+    values, counts = values[known], counts[known]
+    order = np.argsort(values, kind='stable')
+    return values[order], counts[order]
+
+
+def values_at_ranks(values, counts, ranks):
+    """
+    Values at fractional `ranks` (0-based) of the sorted data, interpolated
+    between two neighbours as np.quantile does
+    """
+    cumulated = np.cumsum(counts)
+    ranks = np.asarray(ranks, dtype='float64')
+    lower = np.floor(ranks)
+    upper = np.minimum(lower + 1, cumulated[-1] - 1)
+    lower_values = values[np.searchsorted(cumulated, lower, side='right')]
+    upper_values = values[np.searchsorted(cumulated, upper, side='right')]
+    return lower_values + (upper_values - lower_values) * (ranks - lower)
+
+
+def describe(values, counts=None):
+    """
+    Min, max, mean and median of `values`
+    """
+    values, counts = distinct_values(values, counts)
+    n = counts.sum()
+    return {
+        'min': values[0],
+        'max': values[-1],
+        'mean': np.dot(values, counts) / n,
+        'median': values_at_ranks(values, counts, 0.5 * (n - 1))
+    }
+
+
+def histogram_bins(values, bin_size, start=None, end=None, counts=None):
+    """
+    Number of `values` in each bin of `bin_size` from `start` to `end` (lower
+    edge included, defaults to the range of the values)
+    """
+    values, counts = distinct_values(values, counts)
+    if start is None:
+        start = np.floor(values.min() / bin_size) * bin_size
+    if end is None:
+        end = np.floor(values.max() / bin_size) * bin_size + bin_size
+    edges = np.arange(start, end + bin_size / 2, bin_size)
+    bins, _ = np.histogram(values, edges, weights=counts)
+    return pd.DataFrame({'start': edges[:-1], 'count': bins.astype(np.int64)})
+
+
+def box_stats(values, counts=None):
+    """
+    Quartiles, mean and whiskers (1.5 IQR, as plotly draws them) of `values`.
+    The outliers are summarized by at most MAX_OUTLIER_POINTS of them: the
+    most extreme ones on both sides and quantiles of the others.
+    """
+    values, counts = distinct_values(values, counts)
+    n = counts.sum()
+    q1, median, q3 = values_at_ranks(
+        values, counts, np.array([0.25, 0.5, 0.75]) * (n - 1))
+    iqr = q3 - q1
+    inside = (values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)
+
+    # The outliers are the lowest and the highest ranks of the data
+    below = counts[values < q1 - 1.5 * iqr].sum()
+    above = counts[values > q3 + 1.5 * iqr].sum()
+    n_outliers = below + above
+    if n_outliers > MAX_OUTLIER_POINTS:
+        tail = MAX_OUTLIER_POINTS // 4
+        positions = np.concatenate([
+            np.arange(tail),
+            np.linspace(tail, n_outliers - tail - 1,
+                        MAX_OUTLIER_POINTS - 2 * tail),
+            np.arange(n_outliers - tail, n_outliers)
+        ])
+    else:
+        positions = np.arange(n_outliers)
+    # Interpolates between outliers, not between the two ranks around the
+    # box when a position falls between the last low and first high outlier
+    lower = np.floor(positions)
+    upper = np.minimum(lower + 1, max(n_outliers - 1, 0))
+    lower_values, upper_values = (values_at_ranks(values, counts, np.where(
+        p < below, p, p - below + n - above)) for p in (lower, upper))
+    outliers = lower_values + (upper_values - lower_values) * (positions - lower)
+
+    return {
+        'q1': q1,
+        'median': median,
+        'q3': q3,
+        'mean': np.dot(values, counts) / n,
+        'lowerfence': values[inside].min(),
+        'upperfence': values[inside].max(),
+        'outliers': outliers
+    }
+
+
+def histogram_figure(bins, bin_size, x, title=None, **layout):
+    fig = go.Figure(go.Bar(x=bins['start'] + bin_size / 2, y=bins['count'],
+                           width=bin_size, name='count'))
+    fig.update_layout(title=title, bargap=0, xaxis_title=x,
+                      yaxis_title='count', **layout)
+    return fig
+
+
+def box_figure(stats, y, title=None, **layout):
+    color = px.colors.qualitative.Plotly[0]
+    fig = go.Figure(go.Box(
+        x=[y], q1=[stats['q1']], median=[stats['median']], q3=[stats['q3']],
+        mean=[stats['mean']], lowerfence=[stats['lowerfence']],
+        upperfence=[stats['upperfence']], name=y, marker_color=color))
+    fig.add_trace(go.Scatter(x=[y] * len(stats['outliers']), y=stats['outliers'],
+                             mode='markers', marker_color=color, name='outliers'))
+    fig.update_layout(title=title, yaxis_title=y, showlegend=False, **layout)
+    return fig
+
+
+def threshold_curve_figure(simulator, threshold, scope):
+    curve = simulator.curve(CURVE_THRESHOLDS, scope)
+    fig = make_subplots(specs=[[{'secondary_y': True}]])
+    fig.add_trace(go.Scatter(x=curve['threshold'], y=curve['blocked'],
+                             name='Blocked rentals'), secondary_y=False)
+    fig.add_trace(go.Scatter(x=curve['threshold'], y=curve['solved'],
+                             name='Conflicts solved'), secondary_y=True)
+    fig.add_vline(x=threshold, line_width=3,
+                  line_dash="dash", line_color="black")
+    fig.update_layout(
+        title=f'Blocked rentals and solved conflicts by threshold ({scope} cars)')
+    fig.update_xaxes(title_text='threshold (minutes)')
+    fig.update_yaxes(title_text='blocked rentals', secondary_y=False)
+    fig.update_yaxes(title_text='conflicts solved', secondary_y=True)
+    return fig
+
+
+def cascade_figure(chains, cascade_before, cascade_after, threshold, scope):
+    tmp = pd.DataFrame({
+        'position in the chain': chains.rank,
+        'without the feature': cascade_before['checkin_delay'].to_numpy() > 0,
+        'with the feature': cascade_after['checkin_delay'].to_numpy() > 0
+    }).groupby('position in the chain')[['without the feature', 'with the feature']].sum()
+    tmp = tmp.loc[tmp.index > 0]
+    return px.bar(tmp, barmode='group', text_auto='.0f',
+                  labels={'value': 'delayed checkins', 'variable': ''},
+                  title=f'Delayed checkins by position in the chain of rentals (threshold of {threshold} minutes, {scope} cars)')
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+# Where the columnar copies of the source files are kept
+CACHE_DIR = '.cache'
+
+# Typed schema of the delay analysis export. Delays stay floats: missing
+# values are compared as NaN (i.e. always False) by the analysis
+DTYPES = {
+    'rental_id': 'int32',
+    'car_id': 'int32',
+    'checkin_type': 'category',
+    'state': 'category',
+    'delay_at_checkout_in_minutes': 'float64',
+    'previous_ended_rental_id': 'Int32',
+    'time_delta_with_previous_rental_in_minutes': 'float64',
+}
+
+
+def source_fingerprint(source):
+    """
+    Cheap identifier of the current version of a file
+    """
+    stat = os.stat(source)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_source(source):
+    """
+    Reads the original export (xlsx, csv or parquet) with the typed schema
+    """
+    if source.endswith('.xlsx'):
+        df = pd.read_excel(source)
+    elif source.endswith('.parquet'):
+        df = pd.read_parquet(source)
+    else:
+        df = pd.read_csv(source)
+    return df.astype(DTYPES)
+
+
+def columnar_copy(source, cache_dir=CACHE_DIR):
+    """
+    Path of the typed Parquet copy of the delay analysis export, which
+    `ingest.read_chunks` streams in row batches.
+
+    The (slow) source file is only parsed when its copy is missing or out of
+    date: the copy is reused as long as the source modification time and size
+    are unchanged, or, when they changed, as long as its content hash is the
+    same.
+    """
+    name = os.path.basename(source)
+    cache_path = os.path.join(cache_dir, name + '.parquet')
+    manifest_path = cache_path + '.json'
+    mtime_ns, size = source_fingerprint(source)
+
+    manifest = None
+    if os.path.exists(manifest_path) and os.path.exists(cache_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    if manifest is not None and (manifest['mtime_ns'], manifest['size']) == (mtime_ns, size):
+        return cache_path
+
+    digest = file_hash(source)
+    if manifest is None or manifest['sha256'] != digest:
+        df = read_source(source)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written next to the final file then renamed, so that a concurrent
+        # session never reads a half-written copy
+        df.to_parquet(cache_path + '.tmp', index=False)
+        os.replace(cache_path + '.tmp', cache_path)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'mtime_ns': mtime_ns, 'size': size, 'sha256': digest}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return cache_path
+
@@ -0,0 +1,183 @@
+from collections import Counter
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from binning import time_delta_groups
+from data import columnar_copy, CACHE_DIR
+from simulation import SCOPES
+
+# Rows read at once: the memory used by the ingestion is bounded by the size
+# of a chunk, not by the size of the export
+CHUNK_SIZE = 100_000
+
+# Rows kept as they are, for the "Show raw data" section
+SAMPLE_ROWS = 1_000
+
+# Narrowest types of the columns. Categories are spelled out so that every
+# chunk agrees on them; delays are whole minutes, exact in float32
+NARROW_DTYPES = {
+    'rental_id': 'int32',
+    'car_id': 'int32',
+    'checkin_type': pd.CategoricalDtype(['connect', 'mobile']),
+    'state': pd.CategoricalDtype(['canceled', 'ended']),
+    'delay_at_checkout_in_minutes': 'float32',
+    'previous_ended_rental_id': 'Int32',
+    'time_delta_with_previous_rental_in_minutes': 'float32',
+}
+
+# Read as plain values first: casting to the categories above turns unknown
+# values into NaN, which would silently drop them from every aggregate
+READ_DTYPES = {column: object if isinstance(dtype, pd.CategoricalDtype) else dtype
+               for column, dtype in NARROW_DTYPES.items()}
+
+
+def narrow(chunk):
+    """
+    `chunk` with NARROW_DTYPES, failing on categorical values they don't know
+    (a new state or checkin type in a later export)
+    """
+    for column, dtype in NARROW_DTYPES.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            unknown = set(chunk[column].dropna().unique()) - set(dtype.categories)
+            if unknown:
+                raise ValueError(
+                    f'Unknown {column} values: {sorted(unknown)}, add them to NARROW_DTYPES')
+    return chunk.astype(NARROW_DTYPES)
+
+
+def read_chunks(source, chunksize=CHUNK_SIZE, cache_dir=CACHE_DIR):
+    """
+    Reads the delay analysis export `chunksize` rows at a time, with narrow
+    types. CSV and Parquet files are streamed; a spreadsheet can't be, it is
+    read through its Parquet copy (see `columnar_copy`).
+    """
+    columns = list(NARROW_DTYPES)
+    if source.endswith('.xlsx'):
+        source = columnar_copy(source, cache_dir)
+
+    if source.endswith('.parquet'):
+        for batch in pq.ParquetFile(source).iter_batches(chunksize, columns=columns):
+            yield narrow(batch.to_pandas())
+    else:
+        for chunk in pd.read_csv(source, usecols=columns, dtype=READ_DTYPES,
+                                 chunksize=chunksize):
+            yield narrow(chunk)
+
+
+class DelayAggregates:
+    """
+    Running aggregates of the delay analysis export, folded one chunk at a
+    time (`add`). Everything the summary charts of the dashboard need is a
+    count, so the memory used only depends on the number of distinct values:
+
+    - rows, cars and the first rows of the export (`sample`)
+    - number of rentals by checkin type, by state, by state and checkin type
+      and by state and whether there is a previous rental
+    - number of rentals rented again within 3 hours or not, among the ended
+      ones (with a checkout delay)
+    - number of rentals by time delta with the previous rental, and by
+      checkin type and checkout delay
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.columns = list(NARROW_DTYPES)
+        self.sample = pd.DataFrame(columns=self.columns).astype(NARROW_DTYPES)
+        self._car_ids = np.array([], dtype='int32')
+        self._counts = {name: Counter() for name in [
+            'checkin_type', 'state', 'state_checkin_type', 'state_previous',
+            'time_delta_label', 'time_delta', 'delay']}
+
+    def _count(self, name, keys):
+        counts = keys.value_counts()
+        # categories absent from the chunk are counted 0
+        self._counts[name].update(counts[counts > 0].to_dict())
+
+    def add(self, chunk):
+        if len(self.sample) < SAMPLE_ROWS:
+            self.sample = pd.concat(
+                [self.sample, chunk.head(SAMPLE_ROWS - len(self.sample))], ignore_index=True)
+        self.rows += len(chunk)
+        self._car_ids = np.union1d(self._car_ids, chunk['car_id'].unique())
+
+        delayed = chunk.dropna(subset='delay_at_checkout_in_minutes')
+        self._count('checkin_type', chunk['checkin_type'])
+        self._count('state', chunk['state'])
+        self._count('state_checkin_type', chunk[['state', 'checkin_type']])
+        self._count('state_previous', pd.DataFrame({
+            'state': chunk['state'],
+            'previous': chunk['previous_ended_rental_id'].notna()}))
+        self._count('time_delta_label', pd.Series(time_delta_groups(
+            delayed['time_delta_with_previous_rental_in_minutes'])))
+        self._count('time_delta', chunk['time_delta_with_previous_rental_in_minutes'])
+        self._count('delay', delayed[['checkin_type', 'delay_at_checkout_in_minutes']])
+
+    @property
+    def n_cars(self):
+        return len(self._car_ids)
+
+    @property
+    def n_ended(self):
+        return self._counts['state']['ended']
+
+    def scope_rentals(self):
+        """
+        Number of rentals of each scope of the simulation (see `SCOPES`)
+        """
+        return {'all': self.rows, **{scope: self._counts['checkin_type'][scope]
+                                     for scope in SCOPES if scope != 'all'}}
+
+    def counts(self, name):
+        """
+        Number of rentals by `name` (see the class docstring), most frequent
+        first like `value_counts`
+        """
+        counts = pd.Series(self._counts[name], dtype='int64')
+        if isinstance(counts.index, pd.MultiIndex):
+            counts.index = counts.index.set_names(
+                ['state', name.split('_', 1)[1]])
+        return counts.sort_values(ascending=False, kind='stable')
+
+    def value_counts(self, name, checkin_type=None):
+        """
+        Distinct values of the time delta (`name='time_delta'`) or of the
+        checkout delay (`name='delay'`, of one checkin type or of all) and
+        their number of rentals, as float64 and int64 arrays
+        """
+        counts = pd.Series(self._counts[name], dtype='int64')
+        if name == 'delay':
+            counts = counts.rename_axis(['checkin_type', 'value'])
+            if checkin_type is not None:
+                counts = counts.xs(checkin_type, level='checkin_type')
+            else:
+                counts = counts.groupby(level='value').sum()
+        counts = counts.sort_index()
+        return counts.index.to_numpy(dtype='float64'), counts.to_numpy()
+
+
+def ingest(source, chunksize=CHUNK_SIZE, cache_dir=CACHE_DIR):
+    """
+    Reads the delay analysis export in two streaming passes.
+
+    The first one folds every chunk into `DelayAggregates` and collects the
+    ids of the rentals some rental follows. The second one keeps only the
+    rentals linked to another one: the rentals with a previous rental, and
+    the rentals some rental follows. Those are the only ones the chains of
+    rentals (and so the simulation, the cascades and the cancelation
+    analysis) need.
+
+    Returns the aggregates and the DataFrame of the linked rentals.
+    """
+    aggregates = DelayAggregates()
+    followed = []
+    for chunk in read_chunks(source, chunksize, cache_dir):
+        aggregates.add(chunk)
+        followed.append(chunk['previous_ended_rental_id'].dropna().to_numpy(dtype='int64'))
+    followed = np.unique(np.concatenate(followed or [np.array([], dtype='int64')]))
+
+    linked = []
+    for chunk in read_chunks(source, chunksize, cache_dir):
+        keep = chunk['previous_ended_rental_id'].notna() | chunk['rental_id'].isin(followed)
+        linked.append(chunk.loc[keep])
+    linked = pd.concat(linked, ignore_index=True) if linked else aggregates.sample.head(0)
+    return aggregates, linked
@@ -0,0 +1,160 @@
+from string import Template
+import argparse
+import hashlib
+import json
+import os
+import time
+from cascade import propagate_delays
+from chains import RentalChainIndex
+from charts import threshold_curve_figure, cascade_figure, describe
+from ingest import ingest
+from simulation import ThresholdSimulator
+from utils import render_pdf
+
+REPORT_TEMPLATE = 'report_template.html'
+
+# Where rasterized charts are kept, one file per figure spec hash
+CHARTS_CACHE_DIR = os.path.join('.cache', 'charts')
+
+# Size of the charts in the report, in pixels
+CHART_WIDTH = 900
+CHART_HEIGHT = 500
+
+
+def figure_hash(fig, width=CHART_WIDTH, height=CHART_HEIGHT):
+    spec = json.dumps([fig.to_plotly_json(), width, height],
+                      sort_keys=True, default=str)
+    return hashlib.sha256(spec.encode('utf-8')).hexdigest()
+
+
+class ChartRasterizer:
+    """
+    Rasterizes plotly figures to PNG files (with kaleido), stored under the
+    hash of their spec: a chart is only rasterized again when it changes, so
+    reports of many scenarios share the charts they have in common.
+    """
+
+    def __init__(self, cache_dir=CHARTS_CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def rasterize(self, fig, width=CHART_WIDTH, height=CHART_HEIGHT):
+        path = os.path.join(self.cache_dir, figure_hash(
+            fig, width, height) + '.png')
+        if not os.path.exists(path):
+            image = fig.to_image(format='png', width=width, height=height)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(image)
+            os.replace(path + '.tmp', path)
+        return path
+
+
+def report_metrics(aggregates, simulation, cascade_before, cascade_after):
+    """
+    Numbers of the report for a simulated threshold and scope (`aggregates`
+    are the `DelayAggregates` of the export)
+    """
+    delays, counts = aggregates.value_counts(
+        'delay', None if simulation.scope == 'all' else simulation.scope)
+    late_solved = (delays > 0) & (delays <= simulation.threshold)
+    return {
+        'threshold': simulation.threshold,
+        'scope': simulation.scope,
+        'blocked': simulation.blocked,
+        'blocked_ended': simulation.blocked_ended,
+        'revenue_share': simulation.revenue_share,
+        'median_time_delta': describe(*aggregates.value_counts('time_delta'))['median'],
+        'mean_checkout_delay': describe(*aggregates.value_counts('delay'))['mean'],
+        'canceled_solved': simulation.canceled_solved,
+        'canceled_conflicts': simulation.canceled_conflicts,
+        'canceled_prevented_share': simulation.canceled_solved / max(simulation.canceled_conflicts, 1),
+        'unexplained_cancelations': int(aggregates.counts('state_previous').get(('canceled', False), 0)),
+        'late_checkouts_solved': int(counts[late_solved].sum()),
+        'conflicts_solved': simulation.solved,
+        'conflicts': simulation.conflicts,
+        'checkins_delayed_before': int((cascade_before['checkin_delay'] > 0).sum()),
+        'checkins_delayed_after': int((cascade_after['checkin_delay'] > 0).sum())
+    }
+
+
+def format_metric(name, value):
+    if name.endswith('_share'):
+        return f'{value:.0%}'
+    if isinstance(value, float):
+        return f'{value:.0f}'
+    return str(value)
+
+
+class ReportBuilder:
+    """
+    Fills the report template with the metrics and the charts of a scenario.
+
+    `content` is cheap to compute and identifies the report (template,
+    metrics and figure specs), `build` rasterizes the charts and returns the
+    HTML: the PDF only has to be rendered again when the content changes.
+    """
+
+    def __init__(self, template=REPORT_TEMPLATE, rasterizer=None):
+        with open(template, 'r', encoding='utf-8') as f:
+            self.template = f.read()
+        self.rasterizer = rasterizer or ChartRasterizer()
+
+    def content(self, metrics, figures):
+        return json.dumps({
+            'template': self.template,
+            'metrics': metrics,
+            'figures': {name: figure_hash(fig) for name, fig in figures.items()}
+        }, sort_keys=True, default=str)
+
+    def build(self, metrics, figures):
+        values = {name: format_metric(name, value)
+                  for name, value in metrics.items()}
+        for name, fig in figures.items():
+            values[name + '_image'] = self.rasterizer.rasterize(fig)
+        return Template(self.template).substitute(values)
+
+
+def scenario(aggregates, linked, chains, simulator, threshold, scope, cascade_before=None):
+    """
+    Metrics and figures of the report for one threshold and scope (see
+    `ingest` for `aggregates` and `linked`)
+    """
+    if cascade_before is None:
+        cascade_before = propagate_delays(linked, chains)
+    cascade_after = propagate_delays(linked, chains, threshold, scope)
+    simulation = simulator.simulate(threshold, scope)
+    metrics = report_metrics(aggregates, simulation, cascade_before, cascade_after)
+    figures = {
+        'threshold_curve': threshold_curve_figure(simulator, threshold, scope),
+        'cascade': cascade_figure(chains, cascade_before, cascade_after, threshold, scope)
+    }
+    return metrics, figures
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Renders the report of several threshold/scope scenarios")
+    parser.add_argument('--data', default='get_around_delay_analysis.xlsx')
+    parser.add_argument('--scenario', action='append', metavar='THRESHOLD:SCOPE',
+                        help="e.g. 180:all or 60:connect, can be repeated (default: 180:all)")
+    parser.add_argument('--output-dir', default='reports')
+    args = parser.parse_args()
+
+    aggregates, linked = ingest(args.data)
+    chains = RentalChainIndex(linked)
+    simulator = ThresholdSimulator(
+        linked, chains, aggregates.scope_rentals(), aggregates.n_ended)
+    cascade_before = propagate_delays(linked, chains)
+    builder = ReportBuilder()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for name in args.scenario or ['180:all']:
+        start_time = time.time()
+        threshold, scope = name.split(':')
+        metrics, figures = scenario(
+            aggregates, linked, chains, simulator, int(threshold), scope, cascade_before)
+        path = os.path.join(args.output_dir, f'report_{threshold}_{scope}.pdf')
+        with open(path, 'wb') as f:
+            f.write(render_pdf(builder.build(metrics, figures)))
+        print(f"{path} written in {time.time() - start_time:.2f}s")
@@ -0,0 +1,123 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Cars the minimum delay between two rentals can be enabled for
+SCOPES = ['all', 'connect', 'mobile']
+
+Simulation = namedtuple('Simulation', [
+    'threshold', 'scope',
+    'rentals', 'blocked', 'blocked_ended', 'revenue_share',
+    'conflicts', 'solved',
+    'canceled_conflicts', 'canceled_solved'
+])
+
+
+class ThresholdSimulator:
+    """
+    Evaluates a minimum delay between two rentals (`threshold`, in minutes)
+    enabled on a scope of cars.
+
+    - blocked: rentals booked less than `threshold` minutes after the end of
+      the previous rental of the car, which the feature would have prevented
+    - blocked_ended: the blocked rentals that ended (the others were canceled)
+    - revenue_share: share of all the ended rentals that are blocked, each
+      rental weighing the same since there is no price in the delay data
+    - conflicts: rentals whose checkin was delayed by the late checkout of
+      the previous rental, solved when the delay was at most `threshold`
+
+    The rentals are looked up once in their previous rental (see
+    `RentalChainIndex`), then the time deltas and checkin delays of each scope
+    are kept sorted: their cumulative counts at any threshold are a binary
+    search away, so moving a slider never filters the DataFrame again.
+
+    When `df` only holds the rentals linked to another one (see `ingest`),
+    `rentals` (number of rentals of each scope) and `n_ended` (number of
+    ended rentals) give the totals of the whole export.
+    """
+
+    def __init__(self, df, chains, rentals=None, n_ended=None):
+        has_previous = chains.previous >= 0
+        previous = df.loc[has_previous, ['state', 'checkin_type']]
+
+        # Early (or unknown) checkouts of the previous driver don't delay the
+        # next one
+        previous_delay = chains.previous_values(
+            df['delay_at_checkout_in_minutes'])[has_previous]
+        previous_delay = np.where(previous_delay > 0, previous_delay, 0)
+        time_delta = df['time_delta_with_previous_rental_in_minutes'].to_numpy()[
+            has_previous]
+        checkin_delay = previous_delay - time_delta
+        conflict = checkin_delay > 0
+        canceled = previous['state'] == 'canceled'
+        ended = previous['state'] == 'ended'
+
+        if n_ended is None:
+            n_ended = int((df['state'] == 'ended').sum())
+        self.n_ended = n_ended
+
+        self._rentals = {}
+        self._time_deltas = {}
+        self._ended_time_deltas = {}
+        self._checkin_delays = {}
+        self._canceled_checkin_delays = {}
+        for scope in SCOPES:
+            if scope == 'all':
+                in_scope = np.ones(len(previous), dtype=bool)
+                self._rentals[scope] = len(df)
+            else:
+                in_scope = (previous['checkin_type'] == scope).to_numpy()
+                self._rentals[scope] = int((df['checkin_type'] == scope).sum())
+            if rentals is not None:
+                self._rentals[scope] = rentals[scope]
+
+            self._time_deltas[scope] = np.sort(time_delta[in_scope])
+            self._ended_time_deltas[scope] = np.sort(
+                time_delta[in_scope & ended.to_numpy()])
+            self._checkin_delays[scope] = np.sort(
+                checkin_delay[in_scope & conflict])
+            self._canceled_checkin_delays[scope] = np.sort(
+                checkin_delay[in_scope & conflict & canceled.to_numpy()])
+
+    def _counts(self, thresholds, scope):
+        # Rentals booked strictly less than `threshold` minutes after the
+        # previous one are blocked, delays of at most `threshold` are absorbed
+        return (
+            np.searchsorted(self._time_deltas[scope], thresholds, side='left'),
+            np.searchsorted(self._ended_time_deltas[scope], thresholds, side='left'),
+            np.searchsorted(self._checkin_delays[scope], thresholds, side='right'),
+            np.searchsorted(self._canceled_checkin_delays[scope], thresholds, side='right')
+        )
+
+    def simulate(self, threshold, scope='all'):
+        blocked, blocked_ended, solved, canceled_solved = self._counts(
+            threshold, scope)
+        return Simulation(
+            threshold=threshold,
+            scope=scope,
+            rentals=self._rentals[scope],
+            blocked=int(blocked),
+            blocked_ended=int(blocked_ended),
+            # exports without ended rentals have no revenue to lose
+            revenue_share=float(blocked_ended / max(self.n_ended, 1)),
+            conflicts=len(self._checkin_delays[scope]),
+            solved=int(solved),
+            canceled_conflicts=len(self._canceled_checkin_delays[scope]),
+            canceled_solved=int(canceled_solved)
+        )
+
+    def curve(self, thresholds, scope='all'):
+        """
+        Blocked rentals and solved conflicts for every threshold of `thresholds`
+        """
+        thresholds = np.asarray(thresholds)
+        blocked, blocked_ended, solved, canceled_solved = self._counts(
+            thresholds, scope)
+        return pd.DataFrame({
+            'threshold': thresholds,
+            'blocked': blocked,
+            'revenue_share': blocked_ended / max(self.n_ended, 1),
+            'solved': solved,
+            'canceled_solved': canceled_solved
+        })
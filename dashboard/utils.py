@@ -1,22 +1,108 @@
 from fpdf import FPDF, HTMLMixin
-import base64
-import streamlit as st
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import hashlib
+import os
+import threading
+import fpdf
 
+# Where rendered reports are kept, one file per content hash
+REPORTS_CACHE_DIR = os.path.join('.cache', 'reports')
 
-class MyFPDF(FPDF, HTMLMixin):
-    pass
+# Rendered reports kept in memory, older ones are read back from the disk
+MAX_REPORTS_IN_MEMORY = 8
 
 
-def create_download_link(val, filename):
-    b64 = base64.b64encode(val)  # val looks like b'...'
-    return f'<a style="padding: 10px; border: 1px solid #fff; text-decoration: none;" href="data:application/octet-stream;base64,{b64.decode()}" download="{filename}.pdf">🚀 Export Report</a>'
+class MyFPDF(FPDF, HTMLMixin):
+    pass
 
 
-def generate_pdf(html_file):
+def render_pdf(html):
     pdf = MyFPDF()
     pdf.add_page()
     pdf.set_font('helvetica', size=12)
-    html = open(html_file, 'r', encoding='utf-8').read()
     pdf.write_html(html)
-    pdf_link = create_download_link(pdf.output(dest="S"), "report")
-    return pdf_link
+    return bytes(pdf.output())
+
+
+def content_hash(content):
+    # the renderer version is part of the key: a new fpdf2 may render the
+    # same HTML differently
+    return hashlib.sha256(f'{fpdf.__version__}\n{content}'.encode('utf-8')).hexdigest()
+
+
+class ReportRenderer:
+    """
+    Renders HTML reports to PDF in a background thread.
+
+    Reports are stored under the hash of their content, on disk and for the
+    `max_in_memory` most recent ones in memory, so a report is only rendered
+    again when its content changes (and never twice at the same time, however
+    many sessions ask for it).
+    """
+
+    def __init__(self, cache_dir=REPORTS_CACHE_DIR, max_in_memory=MAX_REPORTS_IN_MEMORY):
+        self.cache_dir = cache_dir
+        self.max_in_memory = max_in_memory
+        # key -> future of the PDF bytes, least recently used first
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='report-renderer')
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pdf')
+
+    def _render(self, key, build):
+        path = self._path(key)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+
+        pdf = render_pdf(build())
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(pdf)
+        os.replace(path + '.tmp', path)
+        return pdf
+
+    def submit(self, content, build=None):
+        """
+        Starts rendering the report identified by `content` unless it is
+        already rendered (or being rendered), returns its key.
+
+        `content` is the HTML of the report, or anything identifying it when
+        `build` is given: `build()` then returns the HTML, in the background.
+        """
+        key = content_hash(content)
+        with self._lock:
+            future = self._reports.get(key)
+            # a failed rendering is tried again
+            if future is None or (future.done() and future.exception() is not None):
+                self._reports[key] = self._executor.submit(
+                    self._render, key, build or (lambda: content))
+            self._reports.move_to_end(key)
+            # reports still rendering are kept, the others are on disk
+            evictable = [old for old, future in self._reports.items()
+                         if old != key and future.done()]
+            for old in evictable[:max(0, len(self._reports) - self.max_in_memory)]:
+                del self._reports[old]
+        return key
+
+    def get(self, key, timeout=None):
+        """
+        PDF bytes of a submitted report, waiting at most `timeout` seconds
+        (None when it isn't ready yet)
+        """
+        with self._lock:
+            future = self._reports.get(key)
+            if future is not None:
+                self._reports.move_to_end(key)
+        if future is None:
+            # evicted from memory, rendered already
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return None
@@ -0,0 +1,95 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import joblib
+import mlflow
+import numpy as np
+from serving import CompiledPipeline, compile_pipeline, decompress
+
+# Compact export of the trained random forest, logged next to the pickled
+# model: the compiled model served by the API (see `compile_pipeline` in
+# `api/forest.py`), with the narrowest dtypes that keep the predictions of
+# the forest, compressed with gzip. The API decompresses the artifact once
+# and memory-maps it.
+
+# Where the compact model is logged in the runs
+ARTIFACT_PATH = 'compact-model'
+
+
+def float32_below(values):
+    """
+    Largest float32 lower than or equal to each value. Features are float32
+    when they reach the trees, so `x > threshold` and `x > float32_below(threshold)`
+    always agree: thresholds lose precision, not a single split.
+    """
+    rounded = values.astype(np.float32)
+    above = rounded > values
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def compact_pipeline(pipeline):
+    """
+    Compiled model of the fitted pricing `Pipeline`, narrowed: int32 child
+    indices and roots, the smallest integer type that holds the feature
+    indices, float32 thresholds and leaf values
+    """
+    arrays = compile_pipeline(pipeline)
+    return dict(
+        arrays,
+        roots=arrays['roots'].astype(np.int32),
+        children=arrays['children'].astype(np.int32),
+        feature=arrays['feature'].astype(np.min_scalar_type(arrays['n_features'] - 1)),
+        threshold=float32_below(arrays['threshold']),
+        value=arrays['value'].astype(np.float32),
+    )
+
+
+def save_compact(arrays, path):
+    """
+    Writes `arrays` as a gzip-compressed joblib file (`path` ends with
+    `.joblib.gz`)
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        uncompressed = os.path.join(tmp_dir, 'model.joblib')
+        # Compressing the whole file rather than with joblib keeps the arrays
+        # memory-mappable once it is decompressed
+        joblib.dump(arrays, uncompressed)
+        with open(uncompressed, 'rb') as src, gzip.open(path, 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def log_compact_model(pipeline, design):
+    """
+    Logs the compact export of `pipeline` in the active run, along with its
+    size and load time next to the pickled pipeline's, and how much its
+    predictions differ from the forest's on the preprocessed `design` matrix.
+    The artifact is read back and evaluated the way the API does.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, 'pipeline.joblib')
+        joblib.dump(pipeline, pickle_path)
+        start_time = time.time()
+        joblib.load(pickle_path)
+        pickle_load_time = time.time() - start_time
+
+        path = os.path.join(tmp_dir, 'compact_model.joblib.gz')
+        save_compact(compact_pipeline(pipeline), path)
+        start_time = time.time()
+        model = CompiledPipeline(joblib.load(decompress(path), mmap_mode='r'))
+        load_time = time.time() - start_time
+
+        expected = pipeline.steps[-1][1].predict(design)
+        if hasattr(design, 'toarray'):
+            design = design.toarray()
+        delta = np.abs(model.predict_transformed(np.asarray(design, dtype=np.float32)) - expected)
+
+        mlflow.log_metric("Pickle Size MB", os.path.getsize(pickle_path) / 1e6)
+        mlflow.log_metric("Pickle Load Time", pickle_load_time)
+        mlflow.log_metric("Compact Size MB", os.path.getsize(path) / 1e6)
+        mlflow.log_metric("Compact Load Time", load_time)
+        mlflow.log_metric("Compact Max Delta", delta.max())
+        mlflow.log_metric("Compact Mean Delta", delta.mean())
+        mlflow.log_artifact(path, ARTIFACT_PATH)
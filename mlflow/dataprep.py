@@ -0,0 +1,131 @@
+import joblib
+import pandas as pd
+from sklearn.base import clone
+from sklearn.model_selection import train_test_split
+
+# Pricing data the models are trained on
+DATA = 'get_around_pricing_project.csv'
+
+# Where the preprocessed design matrices are cached
+CACHE_DIR = '.cache/design'
+
+TARGET = 'rental_price_per_day'
+
+# Features fed to the preprocessing, in the order of the CSV file
+NUMERICAL_FEATURES = ['mileage', 'engine_power']
+CATEGORICAL_FEATURES = [
+    'model_key', 'fuel', 'paint_color', 'car_type', 'private_parking_available',
+    'has_gps', 'has_air_conditioning', 'automatic_car', 'has_getaround_connect',
+    'has_speed_regulator', 'winter_tires']
+
+# Type of every column of the pricing data. Categories are read as strings
+# rather than pandas categoricals: the imputer of the preprocessing rejects
+# categoricals, and the API sends plain strings. The features are int64 like
+# the API's: they end up in the signature of the logged models, and MLflow
+# rejects int64 inputs to a model whose signature says int32
+SCHEMA = {
+    'model_key': str,
+    'mileage': 'int64',
+    'engine_power': 'int64',
+    'fuel': str,
+    'paint_color': str,
+    'car_type': str,
+    'private_parking_available': 'bool',
+    'has_gps': 'bool',
+    'has_air_conditioning': 'bool',
+    'automatic_car': 'bool',
+    'has_getaround_connect': 'bool',
+    'has_speed_regulator': 'bool',
+    'winter_tires': 'bool',
+    TARGET: 'int32',
+}
+
+
+def read_dataset(path=DATA):
+    """
+    Reads the pricing data with the types of SCHEMA, failing on missing
+    columns rather than training on whatever columns are there
+    """
+    df = pd.read_csv(path, index_col=0, dtype=SCHEMA)
+    missing = [column for column in SCHEMA if column not in df.columns]
+    if missing:
+        raise ValueError(f'{path} is missing columns: {missing}')
+    return df[list(SCHEMA)]
+
+
+def split_features(df):
+    """
+    Features and target of `df`
+    """
+    return df.drop(columns=TARGET), df[TARGET]
+
+
+def split_dataset(df):
+    """
+    Train / test split of the features and target of `df`
+    """
+    X, y = split_features(df)
+    return train_test_split(X, y, random_state=42, test_size=0.2)
+
+
+def load_dataset(path=DATA):
+    return split_dataset(read_dataset(path))
+
+
+def data_hash(X):
+    """
+    Hash of the values, index, columns and types of `X`, whatever the memory
+    layout of the DataFrame
+    """
+    return joblib.hash((list(X.columns), X.dtypes.astype(str).tolist(),
+                        pd.util.hash_pandas_object(X, index=True).to_numpy()))
+
+
+def _fit_transform(key, preprocessor, X):
+    preprocessor = clone(preprocessor)
+    design = preprocessor.fit_transform(X)
+    return preprocessor, design
+
+
+def _transform(key, preprocessor, X):
+    return preprocessor.transform(X)
+
+
+class DesignCache:
+    """
+    Preprocessed design matrices, cached on disk with `joblib.Memory`.
+
+    `fit_transform` entries are keyed by the hash of the rows and of the
+    configuration of the preprocessor. `transform` entries are keyed by the
+    hash of the rows and by the key the preprocessor was fitted with (the
+    hash of the preprocessor itself when it was fitted elsewhere). Fitting
+    and scoring again on the same data (repeated runs, other regressors, test
+    scores) reuse the matrices instead of encoding the rows again.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        memory = joblib.Memory(cache_dir, verbose=0)
+        # Hashing the objects themselves isn't stable: a DataFrame hashes
+        # differently once copied, a fitted preprocessor once read back from
+        # the cache. Only the keys computed here are hashed by the memory
+        self._fit_transform = memory.cache(_fit_transform, ignore=['preprocessor', 'X'])
+        self._transform = memory.cache(_transform, ignore=['preprocessor', 'X'])
+        # id of the preprocessors fitted by `fit_transform` -> (preprocessor, key)
+        self._fitted = {}
+
+    def fit_transform(self, preprocessor, X):
+        """
+        Fitted copy of `preprocessor` and the design matrix of `X`
+        """
+        key = joblib.hash((joblib.hash(clone(preprocessor)), data_hash(X)))
+        fitted, design = self._fit_transform(key, preprocessor, X)
+        self._fitted[id(fitted)] = (fitted, key)
+        return fitted, design
+
+    def transform(self, preprocessor, X):
+        """
+        Design matrix of `X` by the fitted `preprocessor`
+        """
+        fitted = self._fitted.get(id(preprocessor))
+        fitted_key = fitted[1] if fitted is not None else joblib.hash(preprocessor)
+        return self._transform(joblib.hash((fitted_key, data_hash(X))), preprocessor, X)
@@ -0,0 +1,166 @@
+import argparse
+import os
+import time
+import warnings
+import joblib
+import mlflow
+import numpy as np
+from dataprep import NUMERICAL_FEATURES, load_dataset
+from serving import PRICE_TABLE_FORMAT, PriceTable, category_codes, configuration_keys
+from train import EXPERIMENT_NAME
+
+warnings.filterwarnings('ignore')
+
+# Precomputes the prices of a trained pipeline over the car configurations of
+# the training data, so that the API can look them up instead of walking the
+# forest (see `api/lookup.py`).
+#
+# $ python price_table.py --model models:/random_forest_regressor/latest --output ../api/data/price_table.joblib
+
+# Quantiles of the training data the knots span, cars outside of this range
+# are priced by the model
+KNOT_RANGE = (0.005, 0.995)
+
+# Cars priced per call to the pipeline while filling the table
+CHUNK_SIZE = 200_000
+
+
+def knots(values, n=None):
+    """
+    `n` knots at evenly spaced quantiles of `values`, or every distinct value
+    within KNOT_RANGE when `n` is None
+    """
+    low, high = np.quantile(values, KNOT_RANGE)
+    if n is None:
+        distinct = np.unique(values)
+        return distinct[(distinct >= low) & (distinct <= high)].astype(np.float64)
+    return np.unique(np.quantile(values, np.linspace(*KNOT_RANGE, n)))
+
+
+def build_table(pipeline, X, mileage_knots=33, engine_power_knots=None,
+                fallback='data/compiled_model.joblib'):
+    """
+    Prices every configuration of `X` (categorical values) at every
+    combination of the knots of the numerical features. Returns the table as a dict of arrays, saved
+    uncompressed so that the API can memory-map it.
+    """
+    categorical_columns = [column for column in X.columns if column not in NUMERICAL_FEATURES]
+    categories = [sorted(X[column].dropna().unique().tolist()) for column in categorical_columns]
+    grid = [knots(X['mileage'], mileage_knots), knots(X['engine_power'], engine_power_knots)]
+
+    # Configurations sorted by key, the API finds them with a binary search
+    configurations = X[categorical_columns].dropna().drop_duplicates()
+    keys = configuration_keys(configurations, categorical_columns, category_codes(categories))
+    order = np.argsort(keys)
+    configurations, keys = configurations.iloc[order].reset_index(drop=True), keys[order]
+
+    mesh = [axis.ravel() for axis in np.meshgrid(*grid, indexing='ij')]
+    n_cells = len(mesh[0])
+    per_chunk = max(1, CHUNK_SIZE // n_cells)
+    values = []
+    for start in range(0, len(configurations), per_chunk):
+        chunk = configurations.iloc[start:start + per_chunk]
+        cars = chunk.loc[chunk.index.repeat(n_cells)]
+        for column, axis in zip(NUMERICAL_FEATURES, mesh):
+            cars[column] = np.tile(axis, len(chunk))
+        values.append(pipeline.predict(cars[X.columns]).astype(np.float32))
+
+    return {
+        'format': PRICE_TABLE_FORMAT,
+        'fallback': fallback,
+        'categorical_columns': categorical_columns,
+        'categories': categories,
+        'keys': keys,
+        'numerical_columns': NUMERICAL_FEATURES,
+        'knots': grid,
+        'values': np.concatenate(values).reshape(
+            (len(configurations),) + tuple(len(axis) for axis in grid)),
+    }
+
+
+def approximation_error(table, pipeline, X):
+    """
+    Share of the rows of `X` covered by the table, and the absolute
+    difference between the table and the model on those rows. The table is
+    read by the API's `PriceTable`, as when it is served.
+    """
+    prices, covered = PriceTable(table).lookup(X)
+    errors = np.abs(prices - pipeline.predict(X))[covered]
+    if not len(errors):
+        return {'coverage': 0.0}
+    return {
+        'coverage': covered.mean(),
+        'mean_abs_error': errors.mean(),
+        'p99_abs_error': np.quantile(errors, 0.99),
+        'max_abs_error': errors.max(),
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Builds the price table served by the API in front of the model")
+    parser.add_argument('--model', default='models:/random_forest_regressor/latest',
+                        help="MLflow model URI or local joblib file of the fitted Pipeline")
+    parser.add_argument('--output', default='../api/data/price_table.joblib')
+    parser.add_argument('--fallback', default='data/compiled_model.joblib',
+                        help="Model the API prices the cars outside of the table with "
+                             "(MLflow model URI or joblib file, relative to the API)")
+    parser.add_argument('--mileage-knots', type=int, default=33)
+    parser.add_argument('--engine-power-knots', type=int,
+                        help="Knots of the engine power (default: every distinct value)")
+    parser.add_argument('--n-jobs', type=int, default=-1,
+                        help="Number of threads of the forest, -1 for all cores")
+    args = parser.parse_args()
+
+    if args.model.endswith('.joblib'):
+        pipeline = joblib.load(args.model)
+    else:
+        pipeline = mlflow.sklearn.load_model(args.model)
+    regressor = pipeline.steps[-1][1]
+    if 'n_jobs' in regressor.get_params():
+        regressor.set_params(n_jobs=args.n_jobs)
+
+    mlflow.set_experiment(EXPERIMENT_NAME)
+    experiment = mlflow.get_experiment_by_name(EXPERIMENT_NAME)
+
+    # Configurations and knots come from the training rows, the error on the
+    # test rows is what new quotes can expect
+    X_train, X_test, _, _ = load_dataset()
+
+    with mlflow.start_run(experiment_id=experiment.experiment_id, run_name="price_table"):
+        start_time = time.time()
+        table = build_table(pipeline, X_train, args.mileage_knots,
+                            args.engine_power_knots, args.fallback)
+        build_time = time.time() - start_time
+
+        # Not compressed, so that the API can memory-map the arrays. Renamed
+        # once complete: a running API maps the served table, rewriting it in
+        # place would truncate it under the API
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        partial = f'{args.output}.{os.getpid()}.partial'
+        joblib.dump(table, partial)
+        os.replace(partial, args.output)
+        size = os.path.getsize(args.output) / 1e6
+
+        mlflow.log_param("model", args.model)
+        mlflow.log_param("fallback", args.fallback)
+        mlflow.log_param("configurations", len(table['keys']))
+        mlflow.log_param("mileage_knots", len(table['knots'][0]))
+        mlflow.log_param("engine_power_knots", len(table['knots'][1]))
+        mlflow.log_metric("Build Time", build_time)
+        mlflow.log_metric("Table Size MB", size)
+        print(f"{len(table['keys'])} configurations x {len(table['knots'][0])} mileages "
+              f"x {len(table['knots'][1])} engine powers in {args.output} "
+              f"({size:.1f} MB, {build_time:.0f}s)")
+
+        for name, X in (('Train', X_train), ('Test', X_test)):
+            error = approximation_error(table, pipeline, X)
+            for metric, value in error.items():
+                mlflow.log_metric(f"{name} {metric.replace('_', ' ').title()}", value)
+            print(f"{name}: {error['coverage']:.1%} of the cars in the table" + (
+                f", error vs the model: mean {error['mean_abs_error']:.2f}, "
+                f"p99 {error['p99_abs_error']:.2f}, max {error['max_abs_error']:.2f}"
+                if 'mean_abs_error' in error else ''))
+
+        mlflow.log_artifact(args.output)
@@ -0,0 +1,195 @@
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import mlflow
+import numpy as np
+from mlflow.utils.autologging_utils import disable_autologging
+
+# Profiling mode of `train.py` (`--profile`): time and peak memory of every
+# stage of the training, stacks sampled all along for a flame graph, and the
+# inference latency of the trained pipeline, logged in the run that registers
+# the model so that every version comes with its performance profile.
+
+# Where the profile is logged in the runs
+ARTIFACT_PATH = 'profile'
+
+# Metrics compared with the previous registered version, higher is slower
+LATENCY_METRICS = ['Single Row Latency P50 ms', 'Single Row Latency P99 ms', 'Batch Latency ms']
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread every `interval` seconds from a background
+    thread, and counts the stacks in the folded format of flame graph tools
+    (`flamegraph.pl`, speedscope): one `root;caller;callee count` line per stack
+    """
+
+    def __init__(self, thread_id, interval=0.005, root=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        # Called at each sample, the name of the outermost frame if any
+        self.root = root or (lambda: None)
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            root = self.root()
+            if root is not None:
+                stack.append(root)
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.counts.most_common())
+
+
+def latency(pipeline, X, single_rows=200, batch_repeats=5):
+    """
+    Latency of `pipeline.predict` on single rows of `X` (percentiles over the
+    first `single_rows` rows) and on the whole of `X` (best of `batch_repeats`
+    calls), in milliseconds
+    """
+    single, batch = [], []
+    # Autologging wraps `predict`, which would double the single row latency
+    with disable_autologging():
+        for i in range(min(single_rows, len(X))):
+            row = X.iloc[[i]]
+            start_time = time.perf_counter()
+            pipeline.predict(row)
+            single.append(time.perf_counter() - start_time)
+        for _ in range(batch_repeats):
+            start_time = time.perf_counter()
+            pipeline.predict(X)
+            batch.append(time.perf_counter() - start_time)
+
+    single = np.array(single) * 1000
+    return {
+        'Single Row Latency P50 ms': np.percentile(single, 50),
+        'Single Row Latency P99 ms': np.percentile(single, 99),
+        'Batch Latency ms': min(batch) * 1000,
+        'Batch Rows Per Second': len(X) / min(batch),
+    }
+
+
+def previous_version_metrics(name, run_id):
+    """
+    Metrics of the run of the latest version of the registered model `name`
+    that wasn't registered by `run_id`, None if there is none
+    """
+    client = mlflow.MlflowClient()
+    versions = [version for version in client.search_model_versions(f"name='{name}'")
+                if version.run_id != run_id]
+    if not versions:
+        return None
+    previous = max(versions, key=lambda version: int(version.version))
+    return client.get_run(previous.run_id).data.metrics
+
+
+class TrainingProfiler:
+    """
+    Measures the stages of a training (`with profiler.stage('Tree Fitting'):`)
+    and samples its stacks, from its creation to `log_profile`. A disabled
+    profiler measures nothing, its stages only run their block.
+
+    The peak memory is the peak of the memory allocated through Python and
+    NumPy (tracemalloc), which slows the allocations down: stage times are
+    comparable between profiled runs, not with the times of plain runs.
+    """
+
+    def __init__(self, enabled=True, interval=0.005):
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self.peaks = OrderedDict()
+        self.peak = 0
+        self.current_stage = None
+        if not enabled:
+            return
+        tracemalloc.start()
+        self.sampler = StackSampler(threading.get_ident(), interval,
+                                    root=lambda: self.current_stage)
+        self.sampler.start()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        tracemalloc.reset_peak()
+        self.current_stage = name
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Stages run several times (e.g. transforms) add up
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start_time
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peaks[name] = max(self.peaks.get(name, 0), peak)
+            self.peak = max(self.peak, peak)
+            self.current_stage = None
+
+    def stop(self):
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        self.sampler.stop()
+
+    def log_profile(self, pipeline, X, registered_model_name='random_forest_regressor'):
+        """
+        Stops the profiling and logs it in the active run, along with the
+        latency of the trained `pipeline` on the rows of `X` (measured once
+        the profiling is stopped) and how it compares with the previous
+        version of `registered_model_name`
+        """
+        if not self.enabled:
+            return
+        self.stop()
+
+        metrics = OrderedDict()
+        for name, duration in self.stages.items():
+            metrics[f'{name} Time'] = duration
+            metrics[f'{name} Peak Memory MB'] = self.peaks[name] / 1e6
+        metrics['Peak Memory MB'] = self.peak / 1e6
+        # Whole process, including the memory NumPy doesn't report
+        metrics['Max RSS MB'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        metrics.update(latency(pipeline, X))
+
+        run_id = mlflow.active_run().info.run_id
+        previous = previous_version_metrics(registered_model_name, run_id)
+        for metric in LATENCY_METRICS:
+            if previous and previous.get(metric):
+                metrics[f'{metric} vs Previous'] = metrics[metric] / previous[metric]
+        mlflow.log_metrics(metrics)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'training.folded')
+            with open(path, 'w') as f:
+                f.write(self.sampler.folded())
+            mlflow.log_artifact(path, ARTIFACT_PATH)
+
+        breakdown = ', '.join(f'{name}: {duration:.3f}s' for name, duration in self.stages.items())
+        print(f"Profile: {breakdown}, peak memory {metrics['Peak Memory MB']:.0f} MB, "
+              f"single row p50 {metrics['Single Row Latency P50 ms']:.2f} ms, "
+              f"batch of {len(X)} {metrics['Batch Latency ms']:.0f} ms")
+        for metric in LATENCY_METRICS:
+            ratio = metrics.get(f'{metric} vs Previous')
+            if ratio is not None and ratio > 1.2:
+                print(f"Warning: {metric} is {ratio:.1f}x the previous version's")
@@ -1,6 +1,7 @@
 docker run -it\
  -p 4000:4000\
- -v "$(pwd):/home/app"\
+ -v "$(pwd)/..:/home/app"\
+ -w /home/app/mlflow\
  -e PORT=4000\
  -e MLFLOW_TRACKING_URI=$MLFLOW_TRACKING_URI\
  -e AWS_ACCESS_KEY_ID=$AWS_ACCESS_KEY_ID\
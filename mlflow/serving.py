@@ -0,0 +1,24 @@
+import os
+import sys
+
+# Formats of the artifacts served by the API are defined by the API itself
+# (`api/forest.py`, `api/lookup.py`): the scripts writing those artifacts
+# import its modules rather than keeping a copy that could silently drift
+# apart.
+#
+# `run.sh` mounts the whole repository so that `../api` is there in the
+# container too.
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+
+# Appended, so that nothing of the API shadows an installed package
+if API_DIR not in sys.path:
+    sys.path.append(API_DIR)
+
+from forest import COMPILED_FORMAT, CompiledPipeline, compile_pipeline, decompress  # noqa: E402
+from lookup import PRICE_TABLE_FORMAT, PriceTable, category_codes, configuration_keys  # noqa: E402
+
+__all__ = [
+    'COMPILED_FORMAT', 'CompiledPipeline', 'compile_pipeline', 'decompress',
+    'PRICE_TABLE_FORMAT', 'PriceTable', 'category_codes', 'configuration_keys',
+]
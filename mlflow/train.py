@@ -1,61 +1,57 @@
 from mlflow.models.signature import infer_signature
+from mlflow.utils.autologging_utils import disable_autologging
+import argparse
 import time
 import mlflow
 import pandas as pd
-import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.model_selection import train_test_split
+from sklearn.linear_model import LinearRegression, Ridge
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.impute import SimpleImputer
 from sklearn.compose import ColumnTransformer
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import RandomForestRegressor, GradientBoostingRegressor
 from sklearn.pipeline import Pipeline
 from sklearn.metrics import r2_score
 from sklearn.model_selection import GridSearchCV
 import warnings
 import joblib
+from compact import log_compact_model
+from dataprep import CATEGORICAL_FEATURES, NUMERICAL_FEATURES, DesignCache, read_dataset, split_dataset, split_features
+from profiling import TrainingProfiler
 
 warnings.filterwarnings('ignore')
 
-if __name__ == "__main__":
-
-    # ### Tracking model with MLFlow
-
-    # Set your variables for your environment
-    EXPERIMENT_NAME = "getaround"
-
-    # Set experiment's info
-    mlflow.set_experiment(EXPERIMENT_NAME)
-    # Get our experiment info
-    experiment = mlflow.get_experiment_by_name(EXPERIMENT_NAME)
-
-    print("training model...")
+# Set your variables for your environment
+EXPERIMENT_NAME = "getaround"
 
-    # Time execution
-    start_time = time.time()
-
-    # Call mlflow autolog
-    mlflow.sklearn.autolog(log_models=False)  # We won't log models right away
-
-    df = pd.read_csv('get_around_pricing_project.csv', index_col=0)
+# Candidates evaluated by the search mode: one grid of parameters per regressor
+SEARCH_CANDIDATES = [
+    {
+        'Regressor': [RandomForestRegressor()],
+        'Regressor__n_estimators': [100, 300],
+        'Regressor__max_features': ['sqrt', 1.0],
+        'Regressor__min_samples_leaf': [1, 2]
+    },
+    {
+        'Regressor': [GradientBoostingRegressor()],
+        'Regressor__n_estimators': [100, 300],
+        'Regressor__learning_rate': [0.05, 0.1]
+    },
+    {
+        'Regressor': [Ridge()],
+        'Regressor__alpha': [0.1, 1.0, 10.0]
+    },
+    {
+        'Regressor': [LinearRegression()]
+    }
+]
 
-    # ## X, Y split
 
-    # Extract the features
-    X = df.drop('rental_price_per_day', axis=1)
+def build_preprocessor():
 
-    # Extract the target column
-    y = df.loc[:, 'rental_price_per_day']
-
-    # Train / test split
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, random_state=42, test_size=0.2)
-
-    # ## Preprocessing
-
-    # determine categorical and numerical features
-    numerical_features = X.select_dtypes(include=['int64', 'float64']).columns
-    categorical_features = X.select_dtypes(include=['object', 'bool']).columns
+    # Features are listed explicitly (see `dataprep.SCHEMA`) rather than
+    # inferred from the dtypes, which depend on the pandas version
+    numerical_features = NUMERICAL_FEATURES
+    categorical_features = CATEGORICAL_FEATURES
 
     # Numerical Transformer
     numerical_transformer = Pipeline([
@@ -75,33 +71,299 @@ if __name__ == "__main__":
             ("categorical_transformer", categorical_transformer, categorical_features)
         ]
     )
+    return preprocessor
+
+
+def fit_design(design_cache, X):
+    """
+    Fitted preprocessing and design matrix of `X`, through the design cache,
+    in the active run.
+
+    The preprocessing is only fitted on cache misses, so autologging is off
+    during the fit and its params are logged here instead: the run holds the
+    same params whether the cache was hit or not.
+    """
+    with disable_autologging():
+        preprocessor, design = design_cache.fit_transform(build_preprocessor(), X)
+    mlflow.log_params({f'preprocessing__{name}': value
+                       for name, value in preprocessor.get_params(deep=True).items()})
+    return preprocessor, design
+
+
+def train(experiment, X_train, X_test, y_train, y_test, design_cache, profiler=None):
+
+    # Stages are only measured in the profiling mode
+    profiler = profiler or TrainingProfiler(enabled=False)
+
+    # Call mlflow autolog
+    mlflow.sklearn.autolog(log_models=False)  # We won't log models right away
 
     # ## Build Model
 
-    # Pipeline Model
-    model = Pipeline(
-        steps=[
-            ("preprocessing", preprocessor),
-            ("Regressor", RandomForestRegressor(
-                max_features='sqrt', min_samples_leaf=1, n_estimators=300))
-        ]
-    )
+    regressor = RandomForestRegressor(
+        max_features='sqrt', min_samples_leaf=1, n_estimators=300)
 
     # Log experiment to MLFlow
     with mlflow.start_run(experiment_id=experiment.experiment_id):
-        model.fit(X_train, y_train)
-        predictions = model.predict(X_train)
+        # The rows are encoded once (or read from the cache), the forest is
+        # fitted and scored on the design matrices
+        with profiler.stage("Preprocessing Fit"):
+            preprocessor, design_train = fit_design(design_cache, X_train)
+        with profiler.stage("Preprocessing Transform"):
+            design_test = design_cache.transform(preprocessor, X_test)
 
-        mlflow.log_metric("Train Score", model.score(X_train, y_train))
-        mlflow.log_metric("Test Score", model.score(X_test, y_test))
+        with profiler.stage("Tree Fitting"):
+            regressor.fit(design_train, y_train)
+
+        with profiler.stage("Scoring"):
+            predictions = regressor.predict(design_train)
+            mlflow.log_metric("Train Score", r2_score(y_train, predictions))
+            mlflow.log_metric("Test Score", regressor.score(design_test, y_test))
+
+        # Pipeline Model, served as a whole
+        model = Pipeline(
+            steps=[
+                ("preprocessing", preprocessor),
+                ("Regressor", regressor)
+            ]
+        )
 
         # Log model seperately to have more flexibility on setup
+        with profiler.stage("Model Logging"):
+            mlflow.sklearn.log_model(
+                sk_model=model,
+                artifact_path="getaround-optimum-prices",
+                registered_model_name="random_forest_regressor",
+                signature=infer_signature(X_train, predictions)
+            )
+        with profiler.stage("Compact Export"):
+            log_compact_model(model, design_test)
+        profiler.log_profile(model, X_test)
+
+
+def vocabulary_unchanged(preprocessor, X):
+    """
+    Whether every category of `X` is already known by the fitted preprocessor,
+    in which case its one-hot encoding (and so the forest features) is stable
+    """
+    categorical_transformer = preprocessor.named_transformers_[
+        'categorical_transformer']
+    encoder = categorical_transformer.named_steps['encoder']
+    categorical_features = preprocessor.transformers_[1][2]
+    for feature, categories in zip(categorical_features, encoder.categories_):
+        if not set(X[feature].dropna().unique()) <= set(categories):
+            return False
+    return True
+
+
+def train_incremental(experiment, X_train, X_test, y_train, y_test, design_cache, new_data,
+                      new_estimators=50, base_model='models:/random_forest_regressor/latest',
+                      profiler=None):
+    """
+    Grows `new_estimators` more trees on the rows of `new_data` only, on top of
+    the registered random forest, instead of refitting it on the whole history.
+
+    The fitted preprocessing is reused as long as the new rows don't bring new
+    categories, otherwise the forest is refitted from scratch on all the rows.
+    """
+
+    profiler = profiler or TrainingProfiler(enabled=False)
+
+    # Call mlflow autolog
+    mlflow.sklearn.autolog(log_models=False)  # We won't log models right away
+
+    with profiler.stage("New Rows Load"):
+        X_new, y_new = split_features(read_dataset(new_data))
+
+    with profiler.stage("Base Model Load"):
+        model = mlflow.sklearn.load_model(base_model)
+    preprocessor = model.named_steps['preprocessing']
+    regressor = model.named_steps['Regressor']
+    n_estimators = regressor.n_estimators + new_estimators
+
+    # What a full refit on the previous rows and the new ones costs, one unit
+    # being one row used to grow one tree
+    full_refit_tree_rows = n_estimators * (len(X_train) + len(X_new))
+
+    with mlflow.start_run(experiment_id=experiment.experiment_id, run_name="incremental"):
+        mlflow.log_param("base_model", base_model)
+        mlflow.log_param("new_rows", len(X_new))
+
+        start_time = time.time()
+        if vocabulary_unchanged(preprocessor, X_new):
+            mlflow.log_param("mode", "warm_start")
+
+            # Previous trees are kept, only the new ones see the new rows
+            regressor.set_params(warm_start=True, n_estimators=n_estimators)
+            with profiler.stage("Preprocessing Transform"):
+                design_new = design_cache.transform(preprocessor, X_new)
+            with profiler.stage("Tree Fitting"):
+                regressor.fit(design_new, y_new)
+            regressor.set_params(warm_start=False)
+            fitted_tree_rows = new_estimators * len(X_new)
+        else:
+            mlflow.log_param("mode", "full_refit")
+            print("New categories found, refitting the model on all the rows...")
+
+            X_train = pd.concat([X_train, X_new])
+            y_train = pd.concat([y_train, y_new])
+            with profiler.stage("Preprocessing Fit"):
+                preprocessor, design_train = fit_design(design_cache, X_train)
+            regressor = RandomForestRegressor(
+                max_features='sqrt', min_samples_leaf=1, n_estimators=n_estimators)
+            with profiler.stage("Tree Fitting"):
+                regressor.fit(design_train, y_train)
+            model = Pipeline(
+                steps=[
+                    ("preprocessing", preprocessor),
+                    ("Regressor", regressor)
+                ]
+            )
+            fitted_tree_rows = full_refit_tree_rows
+        fit_time = time.time() - start_time
+
+        mlflow.log_metric("Fit Time", fit_time)
+        mlflow.log_metric("Fitted Tree Rows", fitted_tree_rows)
+        mlflow.log_metric("Full Refit Tree Rows", full_refit_tree_rows)
+        mlflow.log_metric("Compute Saved", 1 -
+                          fitted_tree_rows / full_refit_tree_rows)
+
+        with profiler.stage("Preprocessing Transform"):
+            design_new = design_cache.transform(preprocessor, X_new)
+            design_test = design_cache.transform(preprocessor, X_test)
+        with profiler.stage("Scoring"):
+            new_predictions = regressor.predict(design_new)
+            mlflow.log_metric("New Rows Score", r2_score(y_new, new_predictions))
+            mlflow.log_metric("Test Score", regressor.score(design_test, y_test))
+
+        with profiler.stage("Model Logging"):
+            mlflow.sklearn.log_model(
+                sk_model=model,
+                artifact_path="getaround-optimum-prices",
+                registered_model_name="random_forest_regressor",
+                signature=infer_signature(X_new, new_predictions)
+            )
+        with profiler.stage("Compact Export"):
+            log_compact_model(model, design_test)
+        profiler.log_profile(model, X_test)
+
+
+def search(experiment, X_train, X_test, y_train, y_test, cv=5, n_jobs=-1, cache_dir='.cache/preprocessing'):
+    """
+    Cross-validates every candidate of SEARCH_CANDIDATES in one process pool.
+
+    The fitted preprocessing of each fold is cached on disk by the Pipeline
+    memory, so it is computed once and reused by every candidate (and by the
+    next searches run with the same data). Each candidate is logged as a
+    nested run with its scores and its fit/score wall time.
+    """
+
+    # Candidates are logged by hand as nested runs
+    mlflow.sklearn.autolog(disable=True)
+
+    memory = joblib.Memory(cache_dir, verbose=0)
+    model = Pipeline(
+        steps=[
+            ("preprocessing", build_preprocessor()),
+            ("Regressor", RandomForestRegressor())
+        ],
+        memory=memory
+    )
+
+    grid_search = GridSearchCV(
+        model, SEARCH_CANDIDATES, cv=cv, n_jobs=n_jobs, return_train_score=True)
+
+    with mlflow.start_run(experiment_id=experiment.experiment_id, run_name="search"):
+        start_time = time.time()
+        grid_search.fit(X_train, y_train)
+        mlflow.log_metric("Search Time", time.time() - start_time)
+
+        results = grid_search.cv_results_
+        for i, params in enumerate(results['params']):
+            regressor = params['Regressor']
+            with mlflow.start_run(experiment_id=experiment.experiment_id,
+                                  run_name=type(regressor).__name__, nested=True):
+                mlflow.log_param("regressor", type(regressor).__name__)
+                mlflow.log_params({name.replace('Regressor__', ''): value
+                                   for name, value in params.items() if name != 'Regressor'})
+                mlflow.log_metric("CV Score", results['mean_test_score'][i])
+                mlflow.log_metric("CV Score Std", results['std_test_score'][i])
+                mlflow.log_metric("Train Score", results['mean_train_score'][i])
+                mlflow.log_metric("Fit Time", results['mean_fit_time'][i])
+                mlflow.log_metric("Score Time", results['mean_score_time'][i])
+                # Time spent on this candidate, summed over the folds
+                mlflow.log_metric(
+                    "Wall Time", (results['mean_fit_time'][i] + results['mean_score_time'][i]) * cv)
+
+        # Best candidate, refitted on the whole training set
+        best_model = grid_search.best_estimator_
+        best_model.set_params(memory=None)
+        mlflow.log_param("best_regressor", type(
+            best_model.named_steps['Regressor']).__name__)
+        mlflow.log_metric("Best CV Score", grid_search.best_score_)
+        mlflow.log_metric("Test Score", best_model.score(X_test, y_test))
+
         mlflow.sklearn.log_model(
-            sk_model=model,
+            sk_model=best_model,
             artifact_path="getaround-optimum-prices",
-            registered_model_name="random_forest_regressor",
-            signature=infer_signature(X_train, predictions)
+            signature=infer_signature(X_train, best_model.predict(X_train))
         )
 
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--search', action='store_true',
+                        help="Cross-validate several regressors instead of training the random forest")
+    parser.add_argument('--incremental', metavar='NEW_ROWS_CSV',
+                        help="Grow more trees on these new rows on top of the registered model")
+    parser.add_argument('--new-trees', type=int, default=50,
+                        help="Number of trees grown by the incremental mode")
+    parser.add_argument('--base-model', default='models:/random_forest_regressor/latest',
+                        help="Model updated by the incremental mode")
+    parser.add_argument('--cv', type=int, default=5,
+                        help="Number of folds of the search")
+    parser.add_argument('--n-jobs', type=int, default=-1,
+                        help="Number of processes of the search, -1 for all cores")
+    parser.add_argument('--cache-dir', default='.cache/preprocessing',
+                        help="Where fitted preprocessing is cached during the search")
+    parser.add_argument('--design-cache-dir', default='.cache/design',
+                        help="Where the preprocessed design matrices are cached")
+    parser.add_argument('--profile', action='store_true',
+                        help="Log stage times, peak memory, inference latency and a "
+                             "flame graph of the training (default and incremental modes)")
+    args = parser.parse_args()
+    if args.profile and args.search:
+        parser.error("--profile profiles the trainings that register a model, not --search")
+
+    # ### Tracking model with MLFlow
+
+    # Set experiment's info
+    mlflow.set_experiment(EXPERIMENT_NAME)
+    # Get our experiment info
+    experiment = mlflow.get_experiment_by_name(EXPERIMENT_NAME)
+
+    print("training model...")
+
+    # Time execution
+    start_time = time.time()
+
+    profiler = TrainingProfiler(enabled=args.profile)
+    with profiler.stage("CSV Load"):
+        df = read_dataset()
+    with profiler.stage("Split"):
+        X_train, X_test, y_train, y_test = split_dataset(df)
+    design_cache = DesignCache(args.design_cache_dir)
+
+    if args.incremental:
+        train_incremental(experiment, X_train, X_test, y_train, y_test, design_cache, args.incremental,
+                          new_estimators=args.new_trees, base_model=args.base_model,
+                          profiler=profiler)
+    elif args.search:
+        search(experiment, X_train, X_test, y_train, y_test,
+               cv=args.cv, n_jobs=args.n_jobs, cache_dir=args.cache_dir)
+    else:
+        train(experiment, X_train, X_test, y_train, y_test, design_cache, profiler)
+
     print("...Done!")
     print(f"---Total training time: {time.time()-start_time}")